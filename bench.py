@@ -0,0 +1,836 @@
+"""
+性能基准与一致性检查（不连接 Telegram / MySQL）
+
+用法：
+    python bench.py settle [--bets 100000]
+    python bench.py parse [--rounds 2000]
+    python bench.py render [--rounds 10000]
+    python bench.py result [--bets 10000] [--bettors 1000] [--max-messages 5]
+    python bench.py rooms [--rooms 500] [--rounds 3] [--telegram-limits]
+    python bench.py dispatch [--rooms 50] [--rounds 3] [--telegram-limits]
+    python bench.py settle-db [--bettors 10 100 1000 5000]（需要 MySQL，请使用测试库）
+    python bench.py recover-db [--bettors 200]（需要 MySQL，请使用测试库）
+    python bench.py webhook [--chats 50] [--updates 2000] [--rate 200] [--replay updates.jsonl]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import threading
+import random
+import re
+import resource
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+import numpy as np
+
+from bet_parser import parse_bets
+from game_logic_func import BetHandler, ODDS, render_dice_board, BOARD_ROWS, BOARD_COLS
+from settlement import BetColumns, settle_columns, user_totals
+from outbound import outbound
+from workers import start_process_pool, shutdown_process_pool
+
+
+def random_bet(rng: random.Random) -> dict:
+    """随机生成一注合法下注"""
+    money = rng.randint(1, 500)
+    kind = rng.choice(["大小", "大小单双", "和值", "对子", "指定对子", "顺子", "豹子", "指定豹子", "定位胆"])
+    if kind == "大小":
+        return {"type": kind, "choice": rng.choice(["d", "x", "da", "xiao"]), "money": money}
+    if kind == "大小单双":
+        return {"type": kind, "choice": rng.choice(["dd", "ds", "xd", "xs"]), "money": money}
+    if kind == "和值":
+        return {"type": kind, "choice": str(rng.randint(4, 17)), "money": money}
+    if kind in ("指定对子", "指定豹子"):
+        return {"type": kind, "choice": rng.randint(1, 6), "money": money}
+    if kind == "定位胆":
+        return {"type": kind, "position": str(rng.randint(1, 3)), "dice_value": str(rng.randint(1, 6)), "money": money}
+    return {"type": kind, "money": money}
+
+
+BET_HANDLERS = {
+    "大小": BetHandler.handle_daxiao,
+    "大小单双": BetHandler.handle_daxiao_danshuang,
+    "和值": BetHandler.handle_hezhi,
+    "对子": BetHandler.handle_duizi,
+    "指定对子": BetHandler.handle_zhiding_duizi,
+    "顺子": BetHandler.handle_shunzi,
+    "豹子": BetHandler.handle_baozi,
+    "指定豹子": BetHandler.handle_zhiding_baozi,
+    "定位胆": BetHandler.handle_dingweidan,
+}
+
+
+async def check_settlement(bets: list):
+    """在全部 216 种骰子结果上对比向量化结算与 BetHandler 的输赢判定和派彩"""
+    columns = BetColumns()
+    for bet in bets:
+        columns.append(0, bet)
+    _, bet_type, choice, position, amount = columns.arrays()
+    for dice in itertools.product(range(1, 7), repeat=3):
+        win, payout = settle_columns(bet_type, choice, position, amount, dice)
+        for row, bet in enumerate(bets):
+            kind = bet['type']
+            _, matched = await BET_HANDLERS[kind](bet, sum(dice) if kind in ["大小", "大小单双", "和值"] else list(dice))
+            odds = ODDS[kind][int(bet['choice'])] if kind == "和值" else ODDS[kind]
+            expected = int(bet['money'] * round(odds * 100) // 100) if matched else -bet['money']
+            assert bool(win[row]) == matched, (dice, bet)
+            assert int(payout[row]) == expected, (dice, bet, int(payout[row]), expected)
+
+
+def bench_settle(count: int):
+    rng = random.Random(42)
+    bets = [random_bet(rng) for _ in range(count)]
+    asyncio.run(check_settlement(bets[:300]))
+    print("✅ 与 BetHandler 在 216 种骰子结果上的判定和派彩一致")
+
+    columns = BetColumns()
+    for bet in bets:
+        columns.append(rng.randrange(count // 10 or 1), bet)
+    user, bet_type, choice, position, amount = columns.arrays()
+
+    runs = []
+    for _ in range(20):
+        dice = [rng.randint(1, 6) for _ in range(3)]
+        start = time.perf_counter()
+        _, payout = settle_columns(bet_type, choice, position, amount, dice)
+        user_totals(user, payout, count // 10 or 1)
+        runs.append(time.perf_counter() - start)
+    print(f"向量化结算 {count} 注: 中位数 {np.median(runs) * 1000:.2f} ms, 最慢 {max(runs) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    dice = [rng.randint(1, 6) for _ in range(3)]
+
+    async def legacy():
+        for bet in bets:
+            kind = bet['type']
+            await BET_HANDLERS[kind](bet, sum(dice) if kind in ["大小", "大小单双", "和值"] else dice)
+
+    asyncio.run(legacy())
+    print(f"BetHandler 逐注结算 {count} 注: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+
+# 群聊语料：下注与闲聊混合
+CHAT_CORPUS = [
+    "dd10", "ds10 xd10", "大单10 大双10 小单10 小双10", "xs 50", "d100", "x 20", "大 30", "小50",
+    "bz1 10", "豹子3 20", "bz100", "dz2 10", "对子50", "sz20", "顺子 10", "hz11 20", "和值 7 50",
+    "dwd1 6 10", "定位胆2 3 20", "2y 10", "dd10 ds10 xd10 xs10",
+    "哈哈哈", "今天手气不错", "老板发包了吗", "666", "？？？", "再来一把", "怎么又是小",
+    "大佬带带我", "刚才那把谁摇的", "🎲", "ok", "余额多少了", "有人吗", "这把压大",
+    "晚上好", "我先撤了", "明天见", "d", "dd", "hz", "1y",
+]
+
+# 旧版逐条尝试的下注规则（仅用于对比）
+LEGACY_BETTING_RULES = {
+    '大小': r'^(大|小|d|x|da|xiao)\s*(\d+)$',
+    '大小单双': r'^(dd|ds|xs|xd|xiaodan|dadan|大单|大双|小单|小双)\s*(\d+)$',
+    '和值': r'^(和值|hz)\s*(4|5|6|7|8|9|10|11|12|13|14|15|16|17)\s*(\d+)$',
+    '对子': r'^(对子|dz)\s*(\d+)$',
+    '指定对子': r'^(对子|dz)\s*([1-6]) (\d+)$',
+    '顺子': r'^(顺子|sz)\s*(\d+)$',
+    '豹子': r'^(豹子|bz)\s*(\d+)$',
+    '指定豹子': r'^(豹子|bz)\s*(1|2|3|4|5|6) (\d+)$',
+    '定位胆': r'^(dwd|定位胆)\s*([1-3])\s*([1-6])\s*(\d+)$',
+    '定位胆y': r'^([1-3])\s*y\s*(\d+)$',
+}
+
+
+def legacy_parse(message: str, to_pinyin=None):
+    """旧版解析：re.sub 后逐条 re.match，大小/单双再转拼音首字母"""
+    message = re.sub(r'\s+', ' ', message).strip()
+    for rule_name, pattern in LEGACY_BETTING_RULES.items():
+        match = re.match(pattern, message)
+        if match:
+            if to_pinyin and rule_name in ('大小', '大小单双'):
+                to_pinyin(match.group(1))
+            return rule_name
+    return None
+
+
+def bench_parse(rounds: int):
+    try:
+        from pypinyin import lazy_pinyin, Style
+
+        def first_letters(text):
+            return ''.join(lazy_pinyin(text, style=Style.FIRST_LETTER))
+    except ImportError:
+        first_letters = None
+        print("未安装 pypinyin，旧版基准不包含拼音转换")
+
+    corpus = CHAT_CORPUS * rounds
+    start = time.perf_counter()
+    for line in corpus:
+        legacy_parse(line, first_letters)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for line in corpus:
+        parse_bets(line)
+    new = time.perf_counter() - start
+
+    print(f"语料 {len(corpus)} 条（{len(CHAT_CORPUS)} 种）")
+    print(f"旧版 BETTING_RULES 循环: {len(corpus) / legacy:,.0f} 条/秒")
+    print(f"单遍预编译解析: {len(corpus) / new:,.0f} 条/秒")
+
+
+BENCH_USER_BASE = 9_000_000_000  # 压测用户 id 段，结束后删除
+
+
+def bench_settle_db(bettors_list: list, bets_per_user: int):
+    """逐注提交的旧结算 vs 单事务批量结算，按下注人数对比耗时"""
+    from database import connect_to_db, create_table_if_not_exists_db, DatabaseManager
+
+    conn, cursor = connect_to_db()
+    if conn is None:
+        print("需要可用的 MySQL（.env 中的 HOST / USER / PASSWORD / DATABASE），请使用测试库")
+        return
+    create_table_if_not_exists_db(cursor, conn)
+    db = DatabaseManager(conn)
+    rng = random.Random(42)
+    try:
+        for bettors in bettors_list:
+            users = range(BENCH_USER_BASE, BENCH_USER_BASE + bettors)
+            cursor.executemany(
+                "INSERT IGNORE INTO users (user_id, username, name, money) VALUES (%s, %s, %s, %s)",
+                [(user_id, f"bench{user_id}", "bench", 10 ** 6) for user_id in users]
+            )
+            conn.commit()
+            bets = [(user_id, random_bet(rng)) for user_id in users for _ in range(bets_per_user)]
+            records = []
+            balances = defaultdict(int)
+            for user_id, bet in bets:
+                win = rng.random() < 0.5
+                money = bet['money'] if win else -bet['money']
+                records.append((user_id, money, bet['money'], bet['type'], win))
+                balances[user_id] += money
+
+            issue_num = f"BENCH{time.time_ns()}"
+            db.place_bets(issue_num, 0, bets)
+            start = time.perf_counter()
+            for user_id, money, _, bet_type, win in records:
+                db.add_bet_info(user_id, money, bet_type, win)
+            db.update_money(list(balances.keys()), list(balances.values()))
+            db.delete_round_bets(issue_num)
+            legacy = time.perf_counter() - start
+
+            issue_num = f"BENCH{time.time_ns()}"
+            db.place_bets(issue_num, 0, bets)
+            start = time.perf_counter()
+            assert db.settle_round(issue_num, 0, records, list(balances.items()))
+            batched = time.perf_counter() - start
+            assert not db.settle_round(issue_num, 0, records, list(balances.items())), "重复结算未被拦截"
+
+            print(f"{bettors} 人 / {len(records)} 注: 逐注提交 {legacy * 1000:.1f} ms, 单事务 {batched * 1000:.1f} ms")
+    finally:
+        cursor.execute("DELETE FROM users WHERE user_id >= %s", (BENCH_USER_BASE,))  # 流水随外键级联删除
+        cursor.execute("DELETE FROM settled_issues WHERE issue LIKE 'BENCH%'")
+        cursor.execute("DELETE FROM pending_bets WHERE issue LIKE 'BENCH%'")
+        conn.commit()
+        conn.close()
+
+
+def bench_recover_db(bettors: int, bets_per_user: int):
+    """模拟进程崩溃后重启：一期已开奖未结算、一期未开奖，检查补结算/退款的余额和幂等性"""
+    from database import connect_to_db, create_table_if_not_exists_db, DatabaseManager, init_db_pool, close_db_pool
+    from recovery import recover_open_rounds
+    from settlement import settle_bet_list
+
+    conn, cursor = connect_to_db()
+    if conn is None:
+        print("需要可用的 MySQL（.env 中的 HOST / USER / PASSWORD / DATABASE），请使用测试库")
+        return
+    create_table_if_not_exists_db(cursor, conn)
+    db = DatabaseManager(conn)
+    rng = random.Random(42)
+    start_money = 10 ** 6
+    users = range(BENCH_USER_BASE, BENCH_USER_BASE + bettors)
+    try:
+        cursor.executemany(
+            "INSERT INTO users (user_id, username, name, money) VALUES (%s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE money = VALUES(money)",
+            [(user_id, f"bench{user_id}", "bench", start_money) for user_id in users]
+        )
+        conn.commit()
+        rounds = {}
+        for suffix in ("DICE", "NODICE"):
+            issue_num = f"BENCH{time.time_ns()}{suffix}"
+            bets = [(user_id, random_bet(rng)) for user_id in users for _ in range(bets_per_user)]
+            # 与 handle_message 一致：写入押注和扣押金在一个事务里
+            for user_id, bet in bets:
+                assert db.reserve_and_place(issue_num, -1, user_id, [bet])
+            rounds[issue_num] = bets
+        dice_issue, refund_issue = rounds
+        # 取消押注：删除押注和退押金在一个事务里，补结算不会再结算或退还这部分
+        cancelled = [bet['money'] for user_id, bet in rounds[dice_issue] if user_id == users[0]]
+        assert db.cancel_user_bets(dice_issue, users[0]) == sum(cancelled)
+        rounds[dice_issue] = [(user_id, bet) for user_id, bet in rounds[dice_issue] if user_id != users[0]]
+        dice = [rng.randint(1, 6) for _ in range(3)]
+        db.record_round_result(dice_issue, -1, dice)
+
+        expected = {user_id: start_money for user_id in users}
+        for user_id, bet in rounds[dice_issue]:
+            expected[user_id] -= bet['money']
+        for user_id, credit in settle_bet_list(rounds[dice_issue], dice)[1]:
+            expected[user_id] += credit
+
+        async def run():
+            await init_db_pool()
+            try:
+                start = time.perf_counter()
+                first = await recover_open_rounds(only=set(rounds))
+                elapsed = time.perf_counter() - start
+                second = await recover_open_rounds(only=set(rounds))
+                return first, second, elapsed
+            finally:
+                await close_db_pool()
+
+        first, second, elapsed = asyncio.run(run())
+        assert sorted(first) == sorted([(dice_issue, "settled"), (refund_issue, "refunded")]), first
+        assert not second, "重复补结算未被拦截"
+        cursor.execute("SELECT user_id, money FROM users WHERE user_id >= %s", (BENCH_USER_BASE,))
+        actual = {row['user_id']: row['money'] for row in cursor.fetchall()}
+        assert actual == expected, "补结算后的余额与预期不一致"
+        print(f"✅ {bettors} 人 × 2 期 × {bets_per_user} 注：补结算 + 退款 {elapsed * 1000:.1f} ms，余额一致，重复执行无变化")
+    finally:
+        cursor.execute("DELETE FROM users WHERE user_id >= %s", (BENCH_USER_BASE,))
+        cursor.execute("DELETE FROM settled_issues WHERE issue LIKE 'BENCH%'")
+        cursor.execute("DELETE FROM round_results WHERE issue LIKE 'BENCH%'")
+        cursor.execute("DELETE FROM pending_bets WHERE issue LIKE 'BENCH%'")
+        conn.commit()
+        conn.close()
+
+
+def current_rss_mb() -> float:
+    """当前常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_render(rounds: int):
+    rng = random.Random(42)
+    points = []
+    timings = []
+    render_dice_board([10])  # 预热精灵图和背景缓存
+    rss_start = current_rss_mb()
+    for round_no in range(1, rounds + 1):
+        points.append(sum(rng.randint(1, 6) for _ in range(3)))
+        start = time.perf_counter()
+        render_dice_board(points)
+        timings.append(time.perf_counter() - start)
+        if len(points) >= BOARD_ROWS * BOARD_COLS:
+            points = []
+        if round_no % (rounds // 5 or 1) == 0:
+            print(f"第 {round_no} 轮: RSS {current_rss_mb():.1f} MB")
+    print(f"渲染 {rounds} 轮: 中位数 {np.median(timings) * 1000:.2f} ms, "
+          f"P99 {np.percentile(timings, 99) * 1000:.2f} ms, RSS 增长 {current_rss_mb() - rss_start:.1f} MB")
+
+
+def bench_result(count: int, bettors: int, max_messages: int):
+    import bet_book
+    from settlement import settle_arrays, format_round_result, bet_detail
+    from outbound import MAX_MESSAGE_LENGTH, MAX_CAPTION_LENGTH
+
+    rng = random.Random(42)
+
+    async def run():
+        book = bet_book.BetBook(-1, "K0000000000000001")
+        for _ in range(count):
+            user_id = rng.randrange(bettors)
+            book.add(user_id, f"玩家{user_id}", random_bet(rng))
+        await book.close()
+        return book
+
+    book = asyncio.run(run())
+    dice = [rng.randint(1, 6) for _ in range(3)]
+    win, payout, totals = settle_arrays(*book.columns.arrays(), dice, len(book.indexed_user_ids()))
+
+    def legacy():
+        """旧写法：逐注字符串拼接成一条图片说明"""
+        result_message = f"🎲 开奖结果：{dice}（总和：{sum(dice)}）\n\n"
+        for user_id, name, bets in book:
+            result_message += f"👤 玩家 {user_id} 的押注结果：\n"
+            for bet, row in zip(bets, book.user_rows(user_id)):
+                if win[row]:
+                    result_message += f"✅ {bet_detail(bet)}，赢了：{int(payout[row])}!\n"
+                else:
+                    result_message += f"❌ {bet_detail(bet)}，输了：{bet['money']}!\n"
+        return result_message
+
+    runs = {"旧写法": [], "format_round_result": [], "format_round_result（不限条数）": []}
+    for _ in range(20):
+        for name, func in (("旧写法", legacy),
+                           ("format_round_result", lambda: format_round_result(
+                               book.issue_num, dice, book, win, payout, totals, max_messages)),
+                           ("format_round_result（不限条数）", lambda: format_round_result(
+                               book.issue_num, dice, book, win, payout, totals, 10 ** 9))):
+            start = time.perf_counter()
+            func()
+            runs[name].append(time.perf_counter() - start)
+    for name, timings in runs.items():
+        print(f"{name} {count} 注 / {bettors} 人: 中位数 {np.median(timings) * 1000:.2f} ms")
+
+    print(f"旧写法图片说明 {len(legacy())} 字符（上限 {MAX_CAPTION_LENGTH}，超出时整张图片发送失败）")
+    caption, chunks = format_round_result(book.issue_num, dice, book, win, payout, totals, max_messages)
+    _, full = format_round_result(book.issue_num, dice, book, win, payout, totals, 10 ** 9)
+    assert len(caption) <= MAX_CAPTION_LENGTH, "图片说明超长"
+    assert all(len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks + full), "明细消息超长"
+    print(f"图片说明 {len(caption)} 字符；明细共 {len(full)} 条，实际发送 {len(chunks)} 条，"
+          f"最长 {max((len(chunk) for chunk in full), default=0)} 字符")
+    print(caption)
+
+
+class FakeDatabase:
+    """内存中的数据库替身：发期号、查余额、扣款和结算总是成功，其余写操作直接返回"""
+    issue = 0
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            return None
+        return call
+
+    async def next_issue(self):
+        FakeDatabase.issue += 1
+        return FakeDatabase.issue
+
+    async def get_user_info(self, user_id):
+        return {"user_id": user_id, "name": str(user_id), "money": 10 ** 9}
+
+    async def reserve_and_place(self, issue_num, chat_id, user_id, bets):
+        return sum(int(bet['money']) for bet in bets)
+
+    async def cancel_user_bets(self, issue_num, user_id):
+        return 0
+
+    async def settle_round(self, issue_num, chat_id, bet_records, balances):
+        return True
+
+
+class FakeBot:
+    """Telegram Bot 替身：记录每个群封盘和发出开奖结果的时间"""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.closed_at = {}  # chat_id -> 本期封盘时间
+        self.latencies = []  # 封盘到开奖结果发出的耗时
+        self.results = defaultdict(int)  # chat_id -> 已开奖期数
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+    async def send_dice(self, chat_id, emoji="🎲", **kwargs):
+        return SimpleNamespace(dice=SimpleNamespace(value=self.rng.randint(1, 6)))
+
+    async def send_animation(self, chat_id, animation, caption, **kwargs):
+        if "下注玩家" in caption:
+            self.closed_at[chat_id] = time.perf_counter()
+        return SimpleNamespace(animation=SimpleNamespace(file_id=animation))
+
+    async def send_photo(self, chat_id, photo, caption, **kwargs):
+        self.latencies.append(time.perf_counter() - self.closed_at.pop(chat_id))
+        self.results[chat_id] += 1
+        return SimpleNamespace()
+
+
+def fake_update(chat_id: int, user_id: int = 0, text: str = ""):
+    async def reply_text(*args, **kwargs):
+        return None
+    user = SimpleNamespace(id=user_id, username=f"u{user_id}", first_name=f"玩家{user_id}", last_name=None)
+    message = SimpleNamespace(text=text, reply_text=reply_text, from_user=user)
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=user, message=message)
+
+
+# 每条下注总额相同，所有玩家并列最大下注，由机器人掷骰子（不等待玩家 25 秒）
+ROOM_BETS = ["dd10 ds10", "大10 小10", "hz11 20", "dwd1 6 10 2y 10", "bz1 20", "sz10 dz10"]
+
+
+def unthrottle_outbound():
+    """关闭发送限速，只测 bot 自身的处理耗时"""
+    outbound.set_global_rate(1e9)
+    outbound.chat_rate = outbound.group_rate = outbound.chat_burst = 1e9
+
+
+def bench_rooms(rooms: int, rounds: int, bettors: int, round_seconds: int, telegram_limits: bool):
+    os.environ.setdefault("DEF_MONEY", "1000")
+    if not telegram_limits:
+        unthrottle_outbound()
+    import game_logic
+    import game_logic_func
+    import handlers
+    import user_cache
+    from game_room import new_room
+
+    for module in (game_logic, game_logic_func, handlers, user_cache):
+        module.AsyncDatabaseManager = FakeDatabase
+    rng = random.Random(42)
+
+    async def feed(context, room):
+        """每期开盘后让 bettors 个玩家各下一条注"""
+        fed = None
+        while True:
+            if room.running and room.issue_num != fed:
+                fed = room.issue_num
+                for user_id in range(1, bettors + 1):
+                    await handlers.handle_message(fake_update(room.chat_id, user_id, rng.choice(ROOM_BETS)), context)
+            await asyncio.sleep(0.05)
+
+    async def run():
+        bot = FakeBot(rng)
+        context = SimpleNamespace(bot=bot, bot_data={"start_game_file_id": "start", "stop_game_file_id": "stop"})
+        feeders = []
+        start = time.perf_counter()
+        for chat_id in range(-1, -rooms - 1, -1):
+            room = new_room(context.bot_data, chat_id, round_seconds)
+            feeders.append(asyncio.create_task(feed(context, room)))
+            await game_logic.start_round(fake_update(chat_id), context)
+        while min(bot.results[chat_id] for chat_id in range(-1, -rooms - 1, -1)) < rounds:
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        for task in asyncio.all_tasks() - {asyncio.current_task()}:
+            task.cancel()
+        return bot, elapsed
+
+    start_process_pool()
+    try:
+        bot, elapsed = asyncio.run(run())
+    finally:
+        shutdown_process_pool()
+    latencies = np.array(bot.latencies) * 1000
+    print(f"{rooms} 个群 × {rounds} 期（每群 {bettors} 个玩家，每期下注 {round_seconds} 秒），共开奖 {len(latencies)} 次，用时 {elapsed:.1f} s")
+    print(f"封盘到开奖结果发出: 中位数 {np.median(latencies):.1f} ms, "
+          f"P99 {np.percentile(latencies, 99):.1f} ms, 最慢 {latencies.max():.1f} ms")
+
+
+def bench_dispatch(rooms: int, rounds: int, bettors: int, round_seconds: int, telegram_limits: bool):
+    """
+    与 rooms 相同的多群对局，但所有下注、开局命令和玩家掷骰子都作为 Update 放进 Application.update_queue，
+    经 PTB 的分发器处理（默认一次处理一个更新）；统计下注从入队到处理完的耗时，以及因排队错过封盘的下注数
+    """
+    from telegram import Update, User
+    from telegram.ext import ExtBot, TypeHandler
+
+    os.environ.setdefault("DEF_MONEY", "1000")
+    os.environ["GAME_NUM"] = str(round_seconds)
+    if not telegram_limits:
+        unthrottle_outbound()
+    import game_logic
+    import game_logic_func
+    import handlers
+    import user_cache
+    from main import build_app
+
+    for module in (game_logic, game_logic_func, handlers, user_cache):
+        module.AsyncDatabaseManager = FakeDatabase
+    rng = random.Random(42)
+    results = defaultdict(int)  # chat_id -> 已开奖期数
+    me = User(id=1, is_bot=True, first_name="bench", username="bench_bot")
+
+    # 只替换本进程里 ExtBot 的网络请求，处理器和分发器都是真实的
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = me
+        return me
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+    async def send_dice(self, chat_id, *args, **kwargs):
+        return SimpleNamespace(dice=SimpleNamespace(value=rng.randint(1, 6)))
+
+    async def send_animation(self, chat_id, animation, *args, **kwargs):
+        return SimpleNamespace(animation=SimpleNamespace(file_id=animation))
+
+    async def send_photo(self, chat_id, photo, *args, **kwargs):
+        results[chat_id] += 1
+        return SimpleNamespace()
+
+    async def delete_message(self, *args, **kwargs):
+        return True
+
+    async def get_chat_administrators(self, chat_id, *args, **kwargs):
+        return [SimpleNamespace(user=SimpleNamespace(id=BENCH_ADMIN_ID))]
+
+    for name, func in (("get_me", get_me), ("send_message", send_message), ("send_dice", send_dice),
+                       ("send_animation", send_animation), ("send_photo", send_photo),
+                       ("delete_message", delete_message), ("get_chat_administrators", get_chat_administrators)):
+        setattr(ExtBot, name, func)
+
+    update_ids = itertools.count(1)
+    sent = {}  # update_id -> (入队时间, 群, 期号)
+    latencies, missed = [], []
+    roller = 1  # 每期唯一的最大下注玩家，由他自己掷骰子
+
+    def make_update(chat_id: int, user_id: int, text: str = None, dice: int = None) -> dict:
+        update_id = next(update_ids)
+        message = {
+            "message_id": update_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"玩家{user_id}"},
+        }
+        if dice is not None:
+            message["dice"] = {"emoji": "🎲", "value": dice}
+        else:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": update_id, "message": message}
+
+    async def run():
+        app = build_app("123456:bench", updater=False)
+        app.bot_data.update(start_game_file_id="start", stop_game_file_id="stop")
+
+        async def record(update: Update, context):
+            """排在所有处理器之后：阻塞的处理器处理完这条更新才会执行到这里"""
+            entry = sent.pop(update.update_id, None)
+            if entry is None:
+                return
+            at, chat_id, issue_num = entry
+            latencies.append(time.perf_counter() - at)
+            room = context.bot_data["rooms"].get(chat_id)
+            if room is None or room.issue_num != issue_num or not room.running:
+                missed.append(update.update_id)
+
+        app.add_handler(TypeHandler(Update, record), group=1)
+        await app.initialize()
+        await app.start()
+
+        async def put(data: dict, chat_id: int = None, issue_num: str = None):
+            if issue_num is not None:
+                sent[data["update_id"]] = (time.perf_counter(), chat_id, issue_num)
+            await app.update_queue.put(Update.de_json(data, app.bot))
+
+        chats = list(range(-1, -rooms - 1, -1))
+        start = time.perf_counter()
+        for chat_id in chats:
+            await put(make_update(chat_id, BENCH_ADMIN_ID, "/start_game"))
+        fed, rolled = {}, {}
+        while min(results[chat_id] for chat_id in chats) < rounds:
+            room_map = app.bot_data.get("rooms", {})
+            for chat_id in chats:
+                room = room_map.get(chat_id)
+                if room is None:
+                    continue
+                if room.running and fed.get(chat_id) != room.issue_num:
+                    # 开盘：最大下注玩家先下一注大的，其余玩家随后陆续下注
+                    fed[chat_id] = room.issue_num
+                    await put(make_update(chat_id, roller, "大5000"), chat_id, room.issue_num)
+                elif room.running:
+                    await put(make_update(chat_id, rng.randint(2, bettors + 1), rng.choice(ROOM_BETS)),
+                              chat_id, room.issue_num)
+                elif room.highest_bet_userid == roller and rolled.get(chat_id) != room.issue_num:
+                    rolled[chat_id] = room.issue_num
+                    for _ in range(3):
+                        await put(make_update(chat_id, roller, dice=rng.randint(1, 6)))
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        for room in app.bot_data["rooms"].values():
+            room.countdown_task.cancel()
+        await app.stop()
+        await app.shutdown()
+        return elapsed
+
+    start_process_pool()
+    try:
+        elapsed = asyncio.run(run())
+    finally:
+        shutdown_process_pool()
+    latencies = np.array(latencies) * 1000
+    print(f"{rooms} 个群 × {rounds} 期（每期下注 {round_seconds} 秒），经 update_queue 处理 {len(latencies)} 条下注，"
+          f"用时 {elapsed:.1f} s")
+    print(f"下注入队到处理完: 中位数 {np.median(latencies):.1f} ms, P99 {np.percentile(latencies, 99):.1f} ms, "
+          f"最慢 {latencies.max():.1f} ms；排队到封盘之后才处理 {len(missed)} 条")
+
+
+BENCH_ADMIN_ID = 42
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """本地 Bot API 替身：应答 bot 发出的请求，并通过 server.on_reply(chat_id) 通知压测客户端"""
+    protocol_version = "HTTP/1.1"  # 保持连接，和真实 Bot API 一样复用 TCP
+    disable_nagle_algorithm = True  # 否则响应头和正文分两次写会碰上延迟确认，每个请求多等 40 ms
+    message_id = itertools.count(1)
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if "json" in self.headers.get("Content-Type", ""):
+            params = json.loads(body or "{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+        chat_id = int(params.get("chat_id", 0))
+        reply_parameters = params.get("reply_parameters") or "{}"
+        if isinstance(reply_parameters, str):
+            reply_parameters = json.loads(reply_parameters)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getChatAdministrators":
+            result = [{"status": "creator", "is_anonymous": False,
+                       "user": {"id": BENCH_ADMIN_ID, "is_bot": False, "first_name": "admin"}}]
+        elif method.startswith("send"):
+            result = {"message_id": next(self.message_id), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "group"}, "text": params.get("text", "")}
+            self.server.on_reply(chat_id, reply_parameters.get("message_id"))
+        else:  # setWebhook / deleteWebhook 等
+            result = True
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def synthetic_updates(chats: int, count: int) -> list:
+    """合成的更新：管理员 /stats（会回复）与群内闲聊（被过滤，不回复）交替"""
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = -1000 - update_id % chats
+        text = "/stats" if update_id % 2 else random.choice(CHAT_CORPUS[21:])
+        message = {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": BENCH_ADMIN_ID, "is_bot": False, "first_name": "admin"},
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+
+def bench_webhook(chats: int, count: int, replay: str, rate: float):
+    import httpx
+
+    unthrottle_outbound()
+    os.environ.setdefault("DEF_MONEY", "1000")
+    api_server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotApi)
+    os.environ["BOT_API_URL"] = f"http://127.0.0.1:{api_server.server_port}/bot"
+    from main import build_app, webhook_config
+
+    if replay:
+        with open(replay, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = synthetic_updates(chats, count)
+    by_chat = defaultdict(list)
+    for update in updates:
+        message = update.get("message") or update.get("edited_message") or {}
+        by_chat[message.get("chat", {}).get("id", 0)].append(update)
+
+    sent, replies = {}, {}  # (chat_id, message_id) -> 时间
+
+    def on_reply(chat_id, reply_to):
+        replies.setdefault((chat_id, reply_to), time.perf_counter())
+
+    async def run():
+        api_server.on_reply = on_reply
+        threading.Thread(target=api_server.serve_forever, daemon=True).start()
+
+        config = webhook_config()
+        port = int(os.getenv("WEBHOOK_PORT", 8443))
+        config.update(listen="127.0.0.1", port=port, webhook_url=f"http://127.0.0.1:{port}/{config['url_path']}")
+        # 只测更新链路，不启动数据库（post_init）
+        app = build_app("123456:bench")
+        await app.initialize()
+        await app.start()
+        await app.updater.start_webhook(**config)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": config["secret_token"]} if config["secret_token"] else {}
+        interval = len(by_chat) / rate
+
+        async def chat_client(client, chat_id, chat_updates):
+            """同一个群的更新按顺序发送，所有群合计约 rate 条/秒"""
+            await asyncio.sleep(random.random() * interval)
+            for update in chat_updates:
+                sent[(chat_id, update["message"]["message_id"])] = time.perf_counter()
+                await client.post(config["webhook_url"], json=update, headers=headers)
+                await asyncio.sleep(interval)
+
+        start = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            await asyncio.gather(*(chat_client(client, chat_id, chat_updates)
+                                   for chat_id, chat_updates in by_chat.items()))
+        await asyncio.sleep(1)  # 等最后几条回复
+        elapsed = time.perf_counter() - start
+        await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+        api_server.shutdown()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    latencies = np.array([replies[key] - at for key, at in sent.items() if key in replies]) * 1000
+    print(f"{len(updates)} 条更新 / {len(by_chat)} 个群（约 {rate:g} 条/秒），用时 {elapsed:.1f} s，"
+          f"{len(latencies)} 条收到回复")
+    if len(latencies):
+        print(f"更新到回复: 中位数 {np.median(latencies):.2f} ms, "
+              f"P99 {np.percentile(latencies, 99):.2f} ms, 最慢 {latencies.max():.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+    settle = sub.add_parser("settle", help="向量化结算基准与一致性检查")
+    settle.add_argument("--bets", type=int, default=100_000)
+    parse = sub.add_parser("parse", help="下注消息解析吞吐")
+    parse.add_argument("--rounds", type=int, default=2000)
+    render = sub.add_parser("render", help="走势图渲染耗时与内存")
+    render.add_argument("--rounds", type=int, default=10_000)
+    settle_db = sub.add_parser("settle-db", help="数据库结算耗时与下注人数的关系（需要 MySQL）")
+    settle_db.add_argument("--bettors", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    settle_db.add_argument("--bets-per-user", type=int, default=3)
+    result = sub.add_parser("result", help="开奖文案生成耗时与消息拆分")
+    result.add_argument("--bets", type=int, default=10_000)
+    result.add_argument("--bettors", type=int, default=1000)
+    result.add_argument("--max-messages", type=int, default=5)
+    recover_db = sub.add_parser("recover-db", help="重启后补结算/退还押金的正确性与幂等性（需要 MySQL）")
+    recover_db.add_argument("--bettors", type=int, default=200)
+    recover_db.add_argument("--bets-per-user", type=int, default=3)
+    rooms = sub.add_parser("rooms", help="单进程多群并发开局的每期延迟")
+    rooms.add_argument("--rooms", type=int, default=500)
+    rooms.add_argument("--rounds", type=int, default=3)
+    rooms.add_argument("--bettors", type=int, default=5)
+    rooms.add_argument("--round-seconds", type=int, default=1)
+    rooms.add_argument("--telegram-limits", action="store_true", help="按 Telegram 限速发送（默认不限速）")
+    dispatch = sub.add_parser("dispatch", help="多群对局的更新经 PTB 分发器处理时的下注延迟")
+    dispatch.add_argument("--rooms", type=int, default=50)
+    dispatch.add_argument("--rounds", type=int, default=3)
+    dispatch.add_argument("--bettors", type=int, default=5)
+    dispatch.add_argument("--round-seconds", type=int, default=3)
+    dispatch.add_argument("--telegram-limits", action="store_true", help="按 Telegram 限速发送（默认不限速）")
+    webhook = sub.add_parser("webhook", help="Webhook 模式下更新到回复的端到端延迟（本地 Bot API 替身）")
+    webhook.add_argument("--chats", type=int, default=50)
+    webhook.add_argument("--updates", type=int, default=2000)
+    webhook.add_argument("--replay", help="按行存放的 Update JSON，替代合成更新")
+    webhook.add_argument("--rate", type=float, default=200, help="所有群合计每秒发送的更新数")
+    args = parser.parse_args()
+
+    if args.command == "settle":
+        bench_settle(args.bets)
+    elif args.command == "parse":
+        bench_parse(args.rounds)
+    elif args.command == "render":
+        bench_render(args.rounds)
+    elif args.command == "settle-db":
+        bench_settle_db(args.bettors, args.bets_per_user)
+    elif args.command == "result":
+        bench_result(args.bets, args.bettors, args.max_messages)
+    elif args.command == "recover-db":
+        bench_recover_db(args.bettors, args.bets_per_user)
+    elif args.command == "rooms":
+        bench_rooms(args.rooms, args.rounds, args.bettors, args.round_seconds, args.telegram_limits)
+    elif args.command == "dispatch":
+        bench_dispatch(args.rooms, args.rounds, args.bettors, args.round_seconds, args.telegram_limits)
+    elif args.command == "webhook":
+        bench_webhook(args.chats, args.updates, args.replay, args.rate)
+
+
+if __name__ == "__main__":
+    main()
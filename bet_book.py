@@ -0,0 +1,145 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from exposure import Exposure, max_exposure
+from settlement import BetColumns
+from user_cache import user_cache
+
+
+class BetBook:
+    """
+    单个群、单期的内存下注簿，是格式化、统计最大下注和结算的读取来源。
+    押注以数据库 pending_bets 为准：下注和取消都先在一个事务里连同押金写入数据库，提交后再更新下注簿，
+    进程在任何时刻崩溃，已扣的押金都能由启动补结算找回。
+    """
+
+    def __init__(self, chat_id: int, issue_num: str):
+        self.chat_id = chat_id
+        self.issue_num = issue_num
+        self.closed = False
+        self._bets = defaultdict(list)  # user_id -> [bet, ...]
+        self._names = {}  # user_id -> 昵称
+        self._totals = defaultdict(int)  # user_id -> 总押注金额
+        self._count = 0
+        self._user_index = {}  # user_id -> 列式存储中的用户下标
+        self._rows = defaultdict(list)  # user_id -> 列式存储中的行号
+        self.columns = BetColumns()  # 结算用的列式存储
+        self.exposure = Exposure(max_exposure())  # 庄家风险敞口
+        self._inflight = 0  # 正在写数据库的下注/取消
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._user_locks = defaultdict(asyncio.Lock)  # 同一用户的下注和取消按顺序执行
+
+    def __len__(self):
+        """本期下注总注数"""
+        return self._count
+
+    def __iter__(self):
+        """按下注先后遍历 (user_id, name, bets)"""
+        for user_id, bets in self._bets.items():
+            yield user_id, self._names[user_id], bets
+
+    def add(self, user_id: int, name: str, bet: dict):
+        """把一注已经写入数据库的下注记入下注簿（含风险敞口）"""
+        self.exposure.add(bet)
+        self._record(user_id, name, bet)
+
+    def _record(self, user_id: int, name: str, bet: dict):
+        self._bets[user_id].append(bet)
+        self._names[user_id] = name
+        self._totals[user_id] += int(bet['money'])
+        self._count += 1
+        user_index = self._user_index.setdefault(user_id, len(self._user_index))
+        self._rows[user_id].append(self.columns.append(user_index, bet))
+
+    @asynccontextmanager
+    async def _busy(self, user_id: int):
+        """登记一次正在进行的数据库写入，封盘时等它完成"""
+        self._inflight += 1
+        self._idle.clear()
+        try:
+            async with self._user_locks[user_id]:
+                yield
+        finally:
+            self._inflight -= 1
+            if not self._inflight:
+                self._idle.set()
+
+    async def place(self, user_id: int, name: str, bets: list):
+        """
+        下注：先占上风险敞口，数据库事务（写 pending_bets + 扣押金）提交后记入下注簿。
+        调用前检查 closed 和 exposure.would_exceed，检查和调用之间不能有 await。
+        :return: 扣掉的押金；余额不足返回 None；这一期已经结算返回 0
+        """
+        if self.closed:
+            raise RuntimeError(f"{self.issue_num}期已封盘")
+        for bet in bets:
+            self.exposure.add(bet)
+        amount = None
+        async with self._busy(user_id):
+            try:
+                amount = await user_cache.place_bets(self.issue_num, self.chat_id, user_id, bets)
+            finally:
+                if amount:
+                    for bet in bets:
+                        self._record(user_id, name, bet)
+                else:
+                    for bet in bets:
+                        self.exposure.remove(bet)
+        return amount
+
+    async def cancel(self, user_id: int):
+        """
+        取消用户本期的全部押注：数据库事务（删除 pending_bets + 退押金）提交后从下注簿移除。
+        :return: (退还的押金, 被移除的下注)；已经封盘或结算时返回 None
+        """
+        if self.closed:
+            return None
+        async with self._busy(user_id):
+            amount = await user_cache.cancel_bets(self.issue_num, user_id)
+            if amount is None:
+                return None
+            return amount, self.remove_user(user_id)
+
+    def remove_user(self, user_id: int) -> list:
+        """移除某个用户本期的全部下注，返回被移除的下注"""
+        bets = self._bets.pop(user_id, [])
+        self._names.pop(user_id, None)
+        self._totals.pop(user_id, None)
+        self._count -= len(bets)
+        self.columns.void(self._rows.pop(user_id, []))
+        for bet in bets:
+            self.exposure.remove(bet)
+        return bets
+
+    def user_bets(self, user_id: int) -> list:
+        """查询某个用户本期的下注"""
+        return list(self._bets.get(user_id, []))
+
+    def total(self, user_id: int) -> int:
+        """查询某个用户本期的总押注金额"""
+        return self._totals.get(user_id, 0)
+
+    def totals(self) -> dict:
+        """所有用户本期的总押注金额"""
+        return dict(self._totals)
+
+    def name(self, user_id: int) -> str:
+        return self._names.get(user_id, "")
+
+    def user_ids(self) -> list:
+        return list(self._bets.keys())
+
+    def user_rows(self, user_id: int) -> list:
+        """某个用户的下注在列式存储中的行号（与 user_bets 顺序一致）"""
+        return list(self._rows.get(user_id, []))
+
+    def indexed_user_ids(self) -> list:
+        """列式存储的用户下标 -> user_id"""
+        return list(self._user_index.keys())
+
+    async def close(self):
+        """封盘：停止接收下注，并等正在写数据库的下注/取消完成（已经扣款或退款的必须算进本期）"""
+        self.closed = True
+        await self._idle.wait()
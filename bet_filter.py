@@ -0,0 +1,50 @@
+from collections import Counter
+
+from telegram import Message
+from telegram.ext import filters
+
+from game_room import get_room
+from bet_parser import BET_FIRST_CHARS
+
+
+class BetPrefilter(filters.MessageFilter):
+    """
+    下注消息的第一道过滤：只看消息类型、首字符和本群是否在下注阶段，
+    不碰数据库也不跑完整解析，普通闲聊、贴纸、图片在这里直接丢弃。
+    """
+
+    def __init__(self, bot_data: dict):
+        super().__init__(name="BetPrefilter")
+        self.bot_data = bot_data
+        self.counters = Counter()
+
+    def filter(self, message: Message) -> bool:
+        self.counters["seen"] += 1
+        text = message.text
+        if not text:
+            self.counters["shed_non_text"] += 1
+            return False
+        text = text.lstrip()
+        if not text or text[0] not in BET_FIRST_CHARS:
+            self.counters["shed_not_bet"] += 1
+            return False
+        room = get_room(self.bot_data, message.chat_id)
+        if room is None or not room.running or room.book is None or room.book.closed:
+            self.counters["shed_out_of_round"] += 1
+            return False
+        self.counters["passed"] += 1
+        return True
+
+    def stats(self) -> str:
+        """过滤统计"""
+        seen = self.counters["seen"]
+        shed = seen - self.counters["passed"]
+        ratio = shed / seen * 100 if seen else 0
+        return (
+            f"收到消息：{seen}\n"
+            f"进入下注处理：{self.counters['passed']}\n"
+            f"已过滤：{shed}（{ratio:.1f}%）\n"
+            f"  非文字：{self.counters['shed_non_text']}\n"
+            f"  非下注：{self.counters['shed_not_bet']}\n"
+            f"  非下注阶段：{self.counters['shed_out_of_round']}"
+        )
@@ -0,0 +1,82 @@
+import re
+
+# 押注选项别名 -> 标准写法（与原先 pypinyin 取首字母的结果一致）
+CHOICE_ALIASES = {
+    '大': 'd', 'da': 'd', 'd': 'd',
+    '小': 'x', 'xiao': 'x', 'x': 'x',
+    '大单': 'dd', 'dadan': 'dd', 'dd': 'dd',
+    '大双': 'ds', 'dashuang': 'ds', 'ds': 'ds',
+    '小单': 'xd', 'xiaodan': 'xd', 'xd': 'xd',
+    '小双': 'xs', 'xiaoshuang': 'xs', 'xs': 'xs',
+}
+
+# 所有下注格式合并为一个预编译正则，按分支顺序消除歧义：
+# 指定对子/指定豹子 的点数与金额之间必须有空格（dz1 10），否则按普通对子/豹子处理（dz110）
+BET_TOKEN = re.compile(r"""
+    (?:
+        (?:dwd|定位胆)\s*(?P<dwd_pos>[1-3])\s*(?P<dwd_val>[1-6])\s*(?P<dwd_amt>\d+)
+      | (?:和值|hz)\s*(?P<hz_val>1[0-7]|[4-9])\s*(?P<hz_amt>\d+)
+      | (?:对子|dz)\s*(?P<zdz_val>[1-6])\s+(?P<zdz_amt>\d+)
+      | (?:对子|dz)\s*(?P<dz_amt>\d+)
+      | (?:豹子|bz)\s*(?P<zbz_val>[1-6])\s+(?P<zbz_amt>\d+)
+      | (?:豹子|bz)\s*(?P<bz_amt>\d+)
+      | (?:顺子|sz)\s*(?P<sz_amt>\d+)
+      | (?P<y_pos>[1-3])\s*y\s*(?P<y_amt>\d+)
+      | (?P<dxds>dd|ds|xs|xd|xiaodan|dadan|xiaoshuang|dashuang|大单|大双|小单|小双)\s*(?P<dxds_amt>\d+)
+      | (?P<dx>da|xiao|大|小|d|x)\s*(?P<dx_amt>\d+)
+    )
+    (?:\s+|$)
+""", re.VERBOSE | re.IGNORECASE)
+
+# 下注消息的第一个字符必然在这个集合里
+BET_FIRST_CHARS = frozenset("dxhbs123定和对豹顺大小DXHBS")
+
+
+def _to_bet(match: re.Match):
+    """把一个匹配转换为下注 dict，金额为 0 时返回 None"""
+    group = match.group
+    if group('dwd_amt'):
+        bet = {"type": "定位胆", "position": group('dwd_pos'), "dice_value": group('dwd_val'), "money": int(group('dwd_amt'))}
+    elif group('hz_amt'):
+        bet = {"type": "和值", "choice": group('hz_val'), "money": int(group('hz_amt'))}
+    elif group('zdz_amt'):
+        bet = {"type": "指定对子", "choice": int(group('zdz_val')), "money": int(group('zdz_amt'))}
+    elif group('dz_amt'):
+        bet = {"type": "对子", "money": int(group('dz_amt'))}
+    elif group('zbz_amt'):
+        bet = {"type": "指定豹子", "choice": int(group('zbz_val')), "money": int(group('zbz_amt'))}
+    elif group('bz_amt'):
+        bet = {"type": "豹子", "money": int(group('bz_amt'))}
+    elif group('sz_amt'):
+        bet = {"type": "顺子", "money": int(group('sz_amt'))}
+    elif group('y_amt'):
+        bet = {"type": "定位胆y", "position": group('y_pos'), "dice_value": group('y_pos'), "money": int(group('y_amt'))}
+    elif group('dxds_amt'):
+        bet = {"type": "大小单双", "choice": CHOICE_ALIASES[group('dxds').lower()], "money": int(group('dxds_amt'))}
+    else:
+        bet = {"type": "大小", "choice": CHOICE_ALIASES[group('dx').lower()], "money": int(group('dx_amt'))}
+    return bet if bet['money'] > 0 else None
+
+
+def parse_bets(text: str) -> list:
+    """
+    单遍解析一条消息中的全部下注，例如 "dd10 ds10 xd10"。
+    只要有一段无法识别，整条消息就不算下注（返回空列表），避免误把闲聊当成下注。
+    """
+    if not text:
+        return []
+    text = text.strip()
+    if not text or text[0] not in BET_FIRST_CHARS:
+        return []
+    bets = []
+    pos, end = 0, len(text)
+    while pos < end:
+        match = BET_TOKEN.match(text, pos)
+        if match is None:
+            return []
+        bet = _to_bet(match)
+        if bet is None:
+            return []
+        bets.append(bet)
+        pos = match.end()
+    return bets
@@ -1,10 +1,17 @@
-import json
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from typing import Union
-from functools import lru_cache
 import pymysql
 import os
 from dotenv import load_dotenv
 
+# 加载环境变量（必须在读取数据库配置之前）
+load_dotenv()
 
 # 从环境变量中获取数据库连接信息
 host = os.getenv("HOST")
@@ -22,8 +29,40 @@ BET_TYPE_MAPPING = {
     "顺子": 6,
     "豹子": 7,
     "指定豹子": 8,
-    "定位胆": 9
+    "定位胆": 9,
+    "定位胆y": 9
+}
+# transactions.transaction_type 交易类型编号
+TRANSACTION_TYPES = {
+    "充值": 1,
+    "提现": 2,
+    "反水": 3,
 }
+# 下注类型编号 -> 下注类型（"定位胆y" 与 "定位胆" 共用编号 9）
+BET_TYPE_NAMES = {code: name for name, code in BET_TYPE_MAPPING.items() if name != "定位胆y"}
+
+
+def bet_to_row(bet: dict) -> tuple:
+    """下注 dict -> pending_bets 的 (bet_type, choice, position, money)"""
+    bet_type = BET_TYPE_MAPPING[bet['type']]
+    if bet_type == BET_TYPE_MAPPING["定位胆"]:
+        return bet_type, str(bet['dice_value']), int(bet['position']), int(bet['money'])
+    choice = bet.get('choice')
+    return bet_type, None if choice is None else str(choice), None, int(bet['money'])
+
+
+def row_to_bet(row: dict) -> dict:
+    """pending_bets 的一行 -> 下注 dict"""
+    bet_type = BET_TYPE_NAMES[row['bet_type']]
+    bet = {"type": bet_type, "money": row['money']}
+    if bet_type == "定位胆":
+        bet["position"] = str(row['position'])
+        bet["dice_value"] = row['choice']
+    elif row['choice'] is not None:
+        # 指定对子/指定豹子的点数按整数比较，其余类型保持字符串
+        bet["choice"] = int(row['choice']) if bet_type in ("指定对子", "指定豹子") else row['choice']
+    return bet
+
 
 def connect_to_db():
     """
@@ -59,7 +98,6 @@ def create_table_if_not_exists_db(cursor, conn):
                 money INT UNSIGNED DEFAULT 0,  -- 余额不允许负值
                 top_up_num INT UNSIGNED DEFAULT 0,  
                 sell_num INT UNSIGNED DEFAULT 0,  
-                bet JSON NULL,  -- JSON 存储押注数据
                 PRIMARY KEY (user_id)  -- 定义主键
             );
         ''')
@@ -79,7 +117,8 @@ def create_table_if_not_exists_db(cursor, conn):
             CREATE TABLE IF NOT EXISTS bets (
                 id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,  
                 user_id BIGINT UNSIGNED NOT NULL,  
-                money INT NOT NULL,
+                money INT NOT NULL,  -- 输赢金额：中奖为 押注金额×赔率，未中奖为 -押注金额
+                stake INT UNSIGNED NULL,  -- 押注金额（流水按它累计）
                 bet_type TINYINT NOT NULL,  -- 允许更多下注类型
                 win TINYINT(1) NOT NULL DEFAULT 0,  -- 0: 输, 1: 赢
                 bet_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  
@@ -88,20 +127,256 @@ def create_table_if_not_exists_db(cursor, conn):
                 INDEX idx_user_id (user_id)  -- 索引优化查询
             );
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pending_bets (
+                id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+                issue VARCHAR(32) NOT NULL,  -- 期号
+                chat_id BIGINT NOT NULL,  -- 群 ID
+                user_id BIGINT UNSIGNED NOT NULL,
+                bet_type TINYINT NOT NULL,  -- 下注类型编号，见 BET_TYPE_MAPPING
+                choice VARCHAR(16) NULL,  -- 押注选项（定位胆为点数）
+                position TINYINT NULL,  -- 定位胆位置
+                money INT UNSIGNED NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                INDEX idx_issue_user (issue, user_id)  -- 按期号范围扫描/删除
+            );
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS settled_issues (
+                issue VARCHAR(32) NOT NULL,  -- 已结算的期号，保证每期只结算一次
+                chat_id BIGINT NOT NULL,
+                bet_count INT UNSIGNED NOT NULL DEFAULT 0,
+                settled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (issue)
+            );
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS round_results (
+                issue VARCHAR(32) NOT NULL,  -- 期号
+                chat_id BIGINT NOT NULL,
+                dice VARCHAR(16) NOT NULL,  -- 三颗骰子点数，如 "3,5,6"
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (issue)  -- 结算失败时凭它补结算
+            );
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_daily_stats (
+                user_id BIGINT UNSIGNED NOT NULL,
+                day DATE NOT NULL,
+                turnover BIGINT UNSIGNED NOT NULL DEFAULT 0,  -- 当日流水（押注金额之和）
+                wins BIGINT UNSIGNED NOT NULL DEFAULT 0,  -- 当日中奖赢的金额
+                losses BIGINT UNSIGNED NOT NULL DEFAULT 0,  -- 当日输的金额
+                bet_count INT UNSIGNED NOT NULL DEFAULT 0,  -- 当日下注注数
+                PRIMARY KEY (user_id, day)  -- 反水/流水查询按主键直接命中
+            );
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rebate_days (
+                day DATE NOT NULL,  -- 已发放反水的日期，保证每天只发一次
+                user_count INT UNSIGNED NOT NULL DEFAULT 0,
+                total BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                paid_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (day)
+            );
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS issue_seq (
+                name VARCHAR(32) NOT NULL,  -- 序列名
+                value BIGINT UNSIGNED NOT NULL,  -- 最近一次发出的编号
+                PRIMARY KEY (name)
+            );
+        ''')
         conn.commit()
+        # 期号序列最先初始化，后面的清理步骤出错也不影响发期号
+        seed_issue_sequence(cursor, conn)
+        drop_legacy_bet_column(cursor, conn)
         print("✅ 用户表检查并创建成功（如果表不存在）")
     except pymysql.MySQLError as err:
         print(f"❌ 创建表失败：{err}")
 
-# 加载环境变量
-load_dotenv()
-@lru_cache(maxsize=10)
-def get_db_connection():
-    return connect_to_db()
+
+def drop_legacy_bet_column(cursor, conn):
+    """
+    删除旧版 users.bet JSON 列。旧版下注时没有扣款，未结算的旧押注直接作废即可，不需要退款；
+    早先迁移进 pending_bets 的 LEGACY 押注同理删除，避免启动补结算把没扣过的押金“退”给用户
+    """
+    cursor.execute("DELETE FROM pending_bets WHERE issue = 'LEGACY'")
+    if cursor.rowcount:
+        print(f"✅ 已删除 {cursor.rowcount} 条旧版未结算押注（旧版下注未扣款）")
+    cursor.execute(
+        "SELECT COUNT(*) AS n FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'users' AND COLUMN_NAME = 'bet'"
+    )
+    if cursor.fetchone()['n']:
+        cursor.execute("SELECT COUNT(*) AS n FROM users WHERE bet IS NOT NULL AND JSON_LENGTH(bet) > 0")
+        dropped = cursor.fetchone()['n']
+        cursor.execute("ALTER TABLE users DROP COLUMN bet")
+        print(f"✅ 已删除 users.bet 列（{dropped} 个用户的旧押注作废）")
+    conn.commit()
+
+
+def seed_issue_sequence(cursor, conn, counter_file: str = "counter.txt"):
+    """初始化期号序列；旧版 counter.txt 存在时从其中的编号继续"""
+    cursor.execute("SELECT value FROM issue_seq WHERE name = 'issue'")
+    if cursor.fetchone():
+        return
+    start = 0
+    if os.path.exists(counter_file):
+        with open(counter_file, encoding="utf-8", errors="ignore") as f:
+            content = f.read().strip()
+        if content.isdigit():
+            start = int(content) - 1  # counter.txt 保存的是下一期要用的编号
+    cursor.execute("INSERT IGNORE INTO issue_seq (name, value) VALUES ('issue', %s)", (max(start, 0),))
+    conn.commit()
+    print(f"✅ 期号序列已初始化，下一期编号 {max(start, 0) + 1}")
+
+
+class ConnectionPool:
+    """线程安全的 pymysql 连接池：限制最大连接数，借出前 ping 并自动重连"""
+
+    def __init__(self, minsize: int = 1, maxsize: int = 10, query_timeout: float = 10, connect_timeout: float = 5):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.query_timeout = query_timeout
+        self.connect_timeout = connect_timeout
+        self._idle = queue.LifoQueue()  # 后进先出，优先复用最近使用过的连接
+        self._slots = threading.BoundedSemaphore(maxsize)  # 同时借出的连接数上限
+        self._closed = False
+
+    def _connect(self):
+        return pymysql.connect(
+            host=host,
+            user=db_user,
+            password=password,
+            database=database,
+            charset='utf8mb4',
+            cursorclass=pymysql.cursors.DictCursor,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.query_timeout,  # socket 级超时，避免工作线程被卡死
+            write_timeout=self.query_timeout,
+        )
+
+    def fill(self):
+        """预先建立 minsize 个连接"""
+        for _ in range(self.minsize - self._idle.qsize()):
+            self._idle.put(self._connect())
+
+    def acquire(self, timeout: float = None):
+        """借出一个可用连接（阻塞调用，只能在工作线程中使用）"""
+        if self._closed:
+            raise RuntimeError("连接池已关闭")
+        if not self._slots.acquire(timeout=timeout if timeout is not None else self.query_timeout):
+            raise TimeoutError("等待数据库连接超时")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            conn.ping(reconnect=True)  # 连接可能已被 MySQL 的 wait_timeout 断开
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, broken: bool = False):
+        """归还连接；出错的连接直接丢弃，由下次借出时重新创建"""
+        try:
+            if broken or self._closed or self._idle.qsize() >= self.maxsize:
+                conn.close()
+            else:
+                self._idle.put(conn)
+        except pymysql.MySQLError:
+            pass
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except pymysql.OperationalError:
+            broken = True
+            raise
+        except BaseException:
+            try:
+                conn.rollback()  # 丢弃未提交的事务，保证归还的连接是干净的
+            except pymysql.MySQLError:
+                broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        """关闭所有空闲连接"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except pymysql.MySQLError:
+                pass
+
+
+_pool = None
+_executor = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """获取全局连接池（首次调用时按环境变量创建）"""
+    global _pool, _executor
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                minsize=int(os.getenv("DB_POOL_MIN", 1)),
+                maxsize=int(os.getenv("DB_POOL_MAX", 10)),
+                query_timeout=float(os.getenv("DB_QUERY_TIMEOUT", 10)),
+                connect_timeout=float(os.getenv("DB_CONNECT_TIMEOUT", 5)),
+            )
+            # 线程数与最大连接数一致，工作线程不会因等待连接而空转
+            _executor = ThreadPoolExecutor(max_workers=_pool.maxsize, thread_name_prefix="db")
+        return _pool
+
+
+async def init_db_pool():
+    """启动时预热连接池"""
+    pool = get_pool()
+    await asyncio.get_running_loop().run_in_executor(_executor, pool.fill)
+    logging.info(f"✅ 数据库连接池已就绪 (min={pool.minsize}, max={pool.maxsize})")
+
+
+async def close_db_pool():
+    """关闭连接池和工作线程"""
+    global _pool, _executor
+    with _pool_lock:
+        pool, executor = _pool, _executor
+        _pool, _executor = None, None
+    if executor:
+        executor.shutdown(wait=True)
+    if pool:
+        pool.close()
+
+
+# 结算时每条 UPDATE ... JOIN 最多更新的用户数
+SETTLE_UPDATE_CHUNK = 1000
+
+
+class RoundChangedError(RuntimeError):
+    """结算数据与 pending_bets 里的押注不一致，需要按 pending_bets 重新结算"""
+
 
 class DatabaseManager:
-    def __init__(self):
-        self.conn, self.cursor = get_db_connection()
+    def __init__(self, conn=None):
+        """不传 conn 时从连接池借出一个连接，close() 时归还"""
+        self._owned = conn is None
+        self.conn = get_pool().acquire() if conn is None else conn
+        self.cursor = self.conn.cursor()
 
     def add_user(self, user_id:int, username: str, name: str, def_money: int):
         """添加新用户（如果不存在）"""
@@ -114,6 +389,18 @@ class DatabaseManager:
         self.cursor.execute("INSERT IGNORE INTO bets (user_id, money, bet_type, win) VALUES (%s, %s, %s, %s)", (user_id, money, bet_type, win))
         self.conn.commit()
 
+    def next_issue(self) -> int:
+        """原子地取下一个期号编号，多进程/多实例安全"""
+        # LAST_INSERT_ID(expr) 的结果随 OK 包返回（cursor.lastrowid），不需要再 SELECT
+        self.cursor.execute("UPDATE issue_seq SET value = LAST_INSERT_ID(value + 1) WHERE name = 'issue'")
+        if self.cursor.rowcount != 1:
+            # 序列没有初始化时 lastrowid 是 0，每期都会变成同一个期号，之后的结算全被当成重复结算
+            self.conn.rollback()
+            raise RuntimeError("期号序列 issue_seq 未初始化，请检查启动时的建表日志")
+        number = self.cursor.lastrowid
+        self.conn.commit()
+        return number
+
     def get_user_id(self, username: str):
         """通过username获取用户id"""
         self.cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
@@ -122,37 +409,224 @@ class DatabaseManager:
 
     def update_money(self, user_ids: list, amounts: list):
         """更新用户余额"""
-        updates = []
+        by_id, by_name = [], []
         for user_id, money in zip(user_ids, amounts):
             money = int(money)
             if isinstance(user_id, int):
-                updates.append((money, user_id, None))  # None 作为占位符
+                by_id.append((money, user_id))
             elif isinstance(user_id, str):
-                updates.append((money, None, user_id))  # None 作为占位符
+                by_name.append((money, user_id))
 
-        self.cursor.executemany("UPDATE users SET money = money + %s WHERE user_id = %s OR username = %s", updates)
+        # 按 id 和按用户名分开更新，各自走索引（OR 条件会退化成全表扫描）
+        if by_id:
+            self.cursor.executemany("UPDATE users SET money = money + %s WHERE user_id = %s", by_id)
+        if by_name:
+            self.cursor.executemany("UPDATE users SET money = money + %s WHERE username = %s", by_name)
         self.conn.commit()
 
-    def place_bet(self, user_id: int, bet: dict):
-        """用户下注"""
-        bets = self.get_user_bet_info(user_id)
-        bet_list = json.loads(bets) if bets else []
-        bet_list.append(bet)
-        self.cursor.execute("UPDATE users SET bet = %s WHERE user_id = %s", (json.dumps(bet_list), user_id))
+    def reserve_and_place(self, issue_num: str, chat_id: int, user_id: int, bets: list):
+        """
+        下注：一个事务写入 pending_bets 并扣押金（带条件的 UPDATE，并发下注也不会透支），
+        提交后进程崩溃也能由启动补结算按 pending_bets 结算或退还。
+        先写押注再扣款：与结算事务加锁顺序一致，不会互相死锁。
+        :return: 扣掉的押金；余额不足（或用户不存在）返回 None；这一期已经结算返回 0。后两种情况什么也没写
+        """
+        amount = sum(int(bet['money']) for bet in bets)
+        try:
+            self.cursor.executemany(
+                "INSERT INTO pending_bets (issue, chat_id, user_id, bet_type, choice, position, money) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [(issue_num, chat_id, user_id) + bet_to_row(bet) for bet in bets]
+            )
+            self.cursor.execute(
+                "UPDATE users SET money = money - %s WHERE user_id = %s AND money >= %s",
+                (amount, user_id, amount)
+            )
+            if self.cursor.rowcount != 1:
+                self.conn.rollback()
+                return None
+            # 结算事务先写结算标记再锁住本期押注：这里看到标记说明结算已经提交，这一注不能再落库
+            self.cursor.execute("SELECT 1 FROM settled_issues WHERE issue = %s", (issue_num,))
+            if self.cursor.fetchone():
+                self.conn.rollback()
+                return 0
+            self.conn.commit()
+            return amount
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def cancel_user_bets(self, issue_num: str, user_id: int):
+        """
+        取消押注：一个事务删除用户本期在 pending_bets 里的押注并退还押金（以数据库里的押注为准）。
+        :return: 退还的押金（没有押注时为 0）；这一期已经结算时返回 None，什么也不做
+        """
+        try:
+            self.cursor.execute(
+                "SELECT id, money FROM pending_bets WHERE issue = %s AND user_id = %s FOR UPDATE",
+                (issue_num, user_id)
+            )
+            rows = self.cursor.fetchall()
+            self.cursor.execute("SELECT 1 FROM settled_issues WHERE issue = %s", (issue_num,))
+            if self.cursor.fetchone():
+                self.conn.rollback()
+                return None
+            amount = sum(int(row['money']) for row in rows)
+            if rows:
+                self.cursor.execute(
+                    f"DELETE FROM pending_bets WHERE id IN ({', '.join(['%s'] * len(rows))})",
+                    [row['id'] for row in rows]
+                )
+                self.cursor.execute("UPDATE users SET money = money + %s WHERE user_id = %s", (amount, user_id))
+            self.conn.commit()
+            return amount
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def record_round_result(self, issue_num: str, chat_id: int, dice: list):
+        """记下一期的开奖点数（结算前写入，结算失败后可以凭它补结算）"""
+        self.cursor.execute(
+            "INSERT IGNORE INTO round_results (issue, chat_id, dice) VALUES (%s, %s, %s)",
+            (issue_num, chat_id, ",".join(str(point) for point in dice))
+        )
         self.conn.commit()
 
-    def delete_bet(self,user_ids:list):
-        """重置指定用户的押注信息"""
-        if not user_ids:
-            return  # 避免 SQL 语法错误
-        placeholders = ",".join(["%s"] * len(user_ids))  # 根据 user_ids 的数量生成占位符
-        sql = f"UPDATE users SET bet = JSON_ARRAY() WHERE user_id IN ({placeholders})"
-        self.cursor.execute(sql, user_ids)
+    def settle_round(self, issue_num: str, chat_id: int, bet_records: list, balances: list) -> bool:
+        """
+        一个事务完成一期结算：写下注流水、累加每日汇总、按用户批量加减余额、清空本期押注，并记下已结算的期号。
+        :param bet_records: [(user_id, 输赢金额, 押注金额, 下注类型, 是否中奖), ...]
+        :param balances: [(user_id, 派彩金额), ...]，押注金额在下注时已经扣除，这里只加回中奖用户的本金和奖金
+        :return: False 表示这一期已经结算过（崩溃后重试、重复调用），本次什么也没做
+        """
+        try:
+            # 先写结算标记：同一期重复结算时会在这里被主键挡下，不会重复派彩
+            self.cursor.execute(
+                "INSERT IGNORE INTO settled_issues (issue, chat_id, bet_count) VALUES (%s, %s, %s)",
+                (issue_num, chat_id, len(bet_records))
+            )
+            if self.cursor.rowcount == 0:
+                self.conn.rollback()
+                return False
+            # 锁住本期押注再核对注数：下注超时后才落库的押注不在 bet_records 里，不能被下面的 DELETE 一起删掉
+            self.cursor.execute("SELECT COUNT(*) AS n FROM pending_bets WHERE issue = %s FOR UPDATE", (issue_num,))
+            count = self.cursor.fetchone()['n']
+            if count != len(bet_records):
+                self.conn.rollback()
+                raise RoundChangedError(f"{issue_num}期 pending_bets 有 {count} 注，结算数据只有 {len(bet_records)} 注")
+            if bet_records:
+                # pymysql 会把 executemany 的 INSERT 合并成多行 INSERT
+                self.cursor.executemany(
+                    "INSERT INTO bets (user_id, money, stake, bet_type, win) VALUES (%s, %s, %s, %s, %s)",
+                    [(user_id, money, stake, BET_TYPE_MAPPING.get(bet_type), win)
+                     for user_id, money, stake, bet_type, win in bet_records]
+                )
+            # 按用户累加当日流水汇总（流水 = 押注金额之和），反水/流水查询不用再扫 bets
+            daily = {}
+            for user_id, money, stake, bet_type, win in bet_records:
+                money, stake = int(money), int(stake)
+                turnover, wins, losses, count = daily.get(user_id, (0, 0, 0, 0))
+                daily[user_id] = (turnover + stake, wins + (money if win else 0), losses + (0 if win else stake),
+                                  count + 1)
+            if daily:
+                self.cursor.execute("SELECT CURDATE() AS day")
+                day = self.cursor.fetchone()['day']
+                self.cursor.executemany(
+                    "INSERT INTO user_daily_stats (user_id, day, turnover, wins, losses, bet_count) "
+                    "VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+                    "turnover = turnover + VALUES(turnover), wins = wins + VALUES(wins), "
+                    "losses = losses + VALUES(losses), bet_count = bet_count + VALUES(bet_count)",
+                    [(user_id, day) + stats for user_id, stats in daily.items()]
+                )
+            for start in range(0, len(balances), SETTLE_UPDATE_CHUNK):
+                chunk = balances[start:start + SETTLE_UPDATE_CHUNK]
+                # 把 (user_id, 变化量) 拼成派生表，一条 UPDATE ... JOIN 按主键更新整批用户
+                derived = " UNION ALL ".join(["SELECT %s AS user_id, %s AS delta"] * len(chunk))
+                self.cursor.execute(
+                    f"UPDATE users u JOIN ({derived}) d ON u.user_id = d.user_id "
+                    f"SET u.money = GREATEST(CAST(u.money AS SIGNED) + d.delta, 0)",
+                    [value for user_id, delta in chunk for value in (user_id, int(delta))]
+                )
+            self.cursor.execute("DELETE FROM pending_bets WHERE issue = %s", (issue_num,))
+            self.conn.commit()
+            return True
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def get_utc_offset(self) -> int:
+        """数据库会话时区相对 UTC 的秒数（每日汇总按数据库的 CURDATE() 划分日期）"""
+        self.cursor.execute("SELECT TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW()) AS offset")
+        return int(self.cursor.fetchone()['offset'])
+
+    def get_unpaid_rebate_days(self) -> list:
+        """
+        待发放反水的日期：上次发放之后、今天（数据库日期）之前有流水的每一天。
+        从没发放过时只发昨天，不会把上线前的历史流水一起补发
+        """
+        self.cursor.execute(
+            "SELECT DISTINCT day FROM user_daily_stats WHERE day < CURDATE() AND day >= COALESCE("
+            "(SELECT MAX(day) + INTERVAL 1 DAY FROM rebate_days), CURDATE() - INTERVAL 1 DAY) ORDER BY day"
+        )
+        return [row['day'] for row in self.cursor.fetchall()]
+
+    def pay_daily_rebates(self, day, rate, min_turnover: int):
+        """
+        一个事务发放某一天的反水：按 user_daily_stats 整表计算，批量写 transactions、批量加余额，并记下已发放的日期。
+        :param rate: 反水比例（Decimal，流水 × rate 向下取整，与 rebate.rebate_amount 一致）
+        :param min_turnover: 流水低于该值不发
+        :return: [(user_id, 反水金额), ...]；这一天已经发放过时返回 None
+        """
+        try:
+            # 先写发放标记：同一天重复执行（多个分片、重启补发）会在这里被主键挡下
+            self.cursor.execute("INSERT IGNORE INTO rebate_days (day) VALUES (%s)", (day,))
+            if self.cursor.rowcount == 0:
+                self.conn.rollback()
+                return None
+            condition = "s.day = %s AND s.turnover >= %s AND FLOOR(s.turnover * %s) > 0"
+            params = (day, min_turnover, rate)
+            self.cursor.execute(
+                f"SELECT s.user_id, FLOOR(s.turnover * %s) AS amount FROM user_daily_stats s "
+                f"JOIN users u ON u.user_id = s.user_id WHERE {condition}",
+                (rate,) + params
+            )
+            rebates = [(row['user_id'], int(row['amount'])) for row in self.cursor.fetchall()]
+            if rebates:
+                self.cursor.execute(
+                    f"INSERT INTO transactions (user_id, amount, transaction_type) "
+                    f"SELECT s.user_id, FLOOR(s.turnover * %s), %s FROM user_daily_stats s "
+                    f"JOIN users u ON u.user_id = s.user_id WHERE {condition}",
+                    (rate, TRANSACTION_TYPES["反水"]) + params
+                )
+                self.cursor.execute(
+                    f"UPDATE users u JOIN user_daily_stats s ON u.user_id = s.user_id "
+                    f"SET u.money = u.money + FLOOR(s.turnover * %s) WHERE {condition}",
+                    (rate,) + params
+                )
+            self.cursor.execute(
+                "UPDATE rebate_days SET user_count = %s, total = %s WHERE day = %s",
+                (len(rebates), sum(amount for _, amount in rebates), day)
+            )
+            self.conn.commit()
+            return rebates
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def place_bets(self, issue_num: str, chat_id: int, bets: list):
+        """批量写入押注（不扣款，压测造数据用）：bets 为 [(user_id, bet), ...]（pymysql 会合并为一条多行 INSERT）"""
+        if not bets:
+            return
+        rows = [(issue_num, chat_id, user_id) + bet_to_row(bet) for user_id, bet in bets]
+        self.cursor.executemany(
+            "INSERT INTO pending_bets (issue, chat_id, user_id, bet_type, choice, position, money) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)", rows
+        )
         self.conn.commit()
 
-    def delete_bets_db(self):
-        """重置所有用户的押注信息（JSON 类型）"""
-        self.cursor.execute("UPDATE users SET bet = JSON_ARRAY()")
+    def delete_round_bets(self, issue_num: str):
+        """清空某一期的全部押注"""
+        self.cursor.execute("DELETE FROM pending_bets WHERE issue = %s", (issue_num,))
         self.conn.commit()
 
     def get_user_info(self, user_id: Union[int, str]):
@@ -171,40 +645,117 @@ class DatabaseManager:
         result = self.cursor.fetchall()
         return result
 
-    def get_user_bet_info(self, user_id: int):
-        """查询指定用户押注信息"""
-        self.cursor.execute("SELECT bet FROM users WHERE user_id = %s", (user_id,))
-        result = self.cursor.fetchone()
-        if not result['bet']:
-            result['bet'] = '[]'
-        return result['bet']
-
-    def get_users_bet_info(self):
-        """查询用户所有押注信息（仅返回 bet 不为空的用户）"""
-        self.cursor.execute("""
-            SELECT user_id, name, bet 
-            FROM users 
-            WHERE bet IS NOT NULL 
-              AND TRIM(bet) != '[]' 
-              AND TRIM(bet) != ''
-        """)
-        result = self.cursor.fetchall()
-        return result
+    def get_open_rounds(self):
+        """
+        有押注但没有结算记录的期号（进程崩溃、重启、结算失败留下的），
+        返回 [{'issue', 'chat_id', 'dice'}, ...]，没有记下开奖点数的 dice 为 None
+        """
+        self.cursor.execute(
+            "SELECT p.issue, MIN(p.chat_id) AS chat_id, r.dice FROM pending_bets p "
+            "LEFT JOIN settled_issues s ON s.issue = p.issue "
+            "LEFT JOIN round_results r ON r.issue = p.issue "
+            "WHERE s.issue IS NULL GROUP BY p.issue, r.dice"
+        )
+        return [
+            {**row, 'dice': [int(point) for point in row['dice'].split(",")] if row['dice'] else None}
+            for row in self.cursor.fetchall()
+        ]
 
-    def get_users_money_info(self):
-        """查询用户所余额信息"""
-        self.cursor.execute("SELECT user_id, name, money FROM users")
-        result = self.cursor.fetchall()
-        return result
+    def refund_round(self, issue_num: str, chat_id: int):
+        """
+        一个事务退还某一期的全部押金（下注时已经扣款），并记入 settled_issues 保证只退一次。
+        :return: [(user_id, 退还金额), ...]；这一期已经结算或退还过时返回 None
+        """
+        try:
+            self.cursor.execute(
+                "SELECT user_id, SUM(money) AS money FROM pending_bets WHERE issue = %s GROUP BY user_id",
+                (issue_num,)
+            )
+            refunds = [(row['user_id'], int(row['money'])) for row in self.cursor.fetchall()]
+            self.cursor.execute(
+                "INSERT IGNORE INTO settled_issues (issue, chat_id, bet_count) VALUES (%s, %s, 0)",
+                (issue_num, chat_id)
+            )
+            if self.cursor.rowcount == 0:
+                self.conn.rollback()
+                return None
+            for start in range(0, len(refunds), SETTLE_UPDATE_CHUNK):
+                chunk = refunds[start:start + SETTLE_UPDATE_CHUNK]
+                derived = " UNION ALL ".join(["SELECT %s AS user_id, %s AS delta"] * len(chunk))
+                self.cursor.execute(
+                    f"UPDATE users u JOIN ({derived}) d ON u.user_id = d.user_id SET u.money = u.money + d.delta",
+                    [value for user_id, delta in chunk for value in (user_id, delta)]
+                )
+            self.cursor.execute("DELETE FROM pending_bets WHERE issue = %s", (issue_num,))
+            self.conn.commit()
+            return refunds
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def get_round_bets(self, issue_num: str):
+        """查询某一期的全部押注，返回 [(user_id, bet), ...]"""
+        self.cursor.execute(
+            "SELECT user_id, bet_type, choice, position, money FROM pending_bets WHERE issue = %s ORDER BY id",
+            (issue_num,)
+        )
+        return [(row['user_id'], row_to_bet(row)) for row in self.cursor.fetchall()]
 
-    def get_user_today_bets(self, user_id):
-        """获取用户今天的所有下注流水"""
+    def get_users_money_page(self, limit: int, offset: int = 0):
+        """按余额从高到低取一页用户（走 money 索引，只读需要的行）"""
         self.cursor.execute(
-            "SELECT * FROM bets WHERE user_id = %s AND DATE(bet_time) = CURDATE()", (user_id,)
+            "SELECT user_id, name, money FROM users ORDER BY money DESC, user_id DESC LIMIT %s OFFSET %s",
+            (limit, offset)
         )
-        return self.cursor.fetchall()  # 返回所有符合条件的记录
+        return self.cursor.fetchall()
+
+    def get_user_today_stats(self, user_id):
+        """获取用户今天的流水汇总（主键查询），今天没有下注时返回 None"""
+        self.cursor.execute(
+            "SELECT turnover, wins, losses, bet_count FROM user_daily_stats WHERE user_id = %s AND day = CURDATE()",
+            (user_id,)
+        )
+        return self.cursor.fetchone()
 
     def close(self):
-        """关闭数据库连接"""
+        """关闭游标，并把连接归还连接池"""
         self.cursor.close()
-        self.conn.close()
\ No newline at end of file
+        if self._owned:
+            self._owned = False
+            get_pool().release(self.conn)
+
+
+class AsyncDatabaseManager:
+    """
+    DatabaseManager 的异步版本，方法与 DatabaseManager 一一对应。
+    每次调用从连接池借出连接，在线程池中执行同步 SQL，事件循环不会被阻塞。
+    """
+
+    def __getattr__(self, name):
+        method = getattr(DatabaseManager, name, None)
+        if name.startswith('_') or name == 'close' or not callable(method):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await self._run(name, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+    @staticmethod
+    def _call_sync(name, args, kwargs):
+        pool = get_pool()
+        with pool.connection() as conn:
+            db = DatabaseManager(conn)
+            try:
+                return getattr(db, name)(*args, **kwargs)
+            finally:
+                db.cursor.close()
+
+    async def _run(self, name, *args, **kwargs):
+        pool = get_pool()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_executor, partial(self._call_sync, name, args, kwargs))
+        # 排队等待连接的时间也计入超时
+        return await asyncio.wait_for(future, timeout=pool.query_timeout * 2)
\ No newline at end of file
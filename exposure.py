@@ -0,0 +1,81 @@
+import itertools
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from settlement import encode_bet, settle_columns
+
+# 三颗骰子的全部 216 种结果
+OUTCOMES = np.array(list(itertools.product(range(1, 7), repeat=3)), dtype=np.int8)
+
+
+@lru_cache(maxsize=256)
+def _outcome_profile(bet_type: int, choice: int, position: int) -> tuple:
+    """
+    预计算某种押注在 216 种结果下是否中奖，以及单位为「百分之一」的赔率
+    :return: (win_mask, odds_cents)
+    """
+    args = (np.array([bet_type], dtype=np.int8), np.array([choice], dtype=np.int16),
+            np.array([position], dtype=np.int8))
+    mask = np.zeros(len(OUTCOMES), dtype=bool)
+    odds_cents = 0
+    for index, dice in enumerate(OUTCOMES):
+        win, payout = settle_columns(*args, np.array([100], dtype=np.int64), dice)
+        mask[index] = win[0]
+        if win[0]:
+            odds_cents = int(payout[0])
+    mask.flags.writeable = False
+    return mask, odds_cents
+
+
+def bet_exposure(bet: dict) -> np.ndarray:
+    """一注下注在 216 种结果下给庄家带来的净赔付（正数为庄家赔钱）"""
+    bet_type, choice, position, money = encode_bet(bet)
+    mask, odds_cents = _outcome_profile(bet_type, choice, position)
+    if bet_type == 0:
+        return np.zeros(len(OUTCOMES), dtype=np.int64)
+    return np.where(mask, money * odds_cents // 100, -money)
+
+
+def max_exposure():
+    """庄家最大可承受赔付，未配置时不限制"""
+    cap = os.getenv("MAX_EXPOSURE") or os.getenv("BANKER_BALANCE")
+    return float(cap) if cap else None
+
+
+class Exposure:
+    """庄家风险敞口表：按 216 种骰子结果增量维护本期庄家的净赔付"""
+
+    def __init__(self, cap: float = None):
+        self.cap = cap
+        self.liability = np.zeros(len(OUTCOMES), dtype=np.int64)
+
+    def would_exceed(self, bets: list) -> bool:
+        """加上这些下注后，最坏情况的赔付是否超过上限"""
+        if self.cap is None:
+            return False
+        liability = self.liability.copy()
+        for bet in bets:
+            liability += bet_exposure(bet)
+        return int(liability.max()) > self.cap
+
+    def add(self, bet: dict):
+        self.liability += bet_exposure(bet)
+
+    def remove(self, bet: dict):
+        self.liability -= bet_exposure(bet)
+
+    def worst(self) -> tuple:
+        """最坏结果：(庄家赔付, 骰子点数)"""
+        index = int(self.liability.argmax())
+        return int(self.liability[index]), OUTCOMES[index].tolist()
+
+    def best(self) -> tuple:
+        """最好结果：(庄家赔付, 骰子点数)"""
+        index = int(self.liability.argmin())
+        return int(self.liability[index]), OUTCOMES[index].tolist()
+
+    def expected(self) -> float:
+        """庄家期望赔付（216 种结果等概率）"""
+        return float(self.liability.mean())
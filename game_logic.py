@@ -1,33 +1,35 @@
 import asyncio
-import base64
-import json
+import os
 import logging
-from collections import defaultdict
-from io import BytesIO
 
 from telegram import Update
 from telegram.ext import CallbackContext
 
-from database import DatabaseManager
-from game_logic_func import BetHandler, issue, safe_send_message, safe_send_dice, dice_photo, get_top_bettor, \
+from game_room import get_room
+from outbound import outbound, log_send_failure, PRIORITY_RESULT
+from user_cache import user_cache
+from database import AsyncDatabaseManager, RoundChangedError
+from game_logic_func import issue, safe_send_message, safe_send_dice, dice_photo, get_top_bettor, \
     format_bet_data, get_animation_file_id
+from settlement import settle_arrays, settle_bet_list, format_round_result
+from workers import run_cpu, SETTLE_INLINE_MAX
 
 # 配置日志
 # logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 结算失败后的重试次数（每次间隔 1、2、4… 秒）
+SETTLE_RETRIES = int(os.getenv("SETTLE_RETRIES", 3))
+
 
 # 1、开始新一轮游戏
 async def start_round(update: Update, context: CallbackContext):
     """ 开始新一轮游戏 """
-    context.bot_data["running"] = True
-
     chat_id = update.effective_chat.id
-
-    context.bot_data["bet_users"] = {}
-
+    room = get_room(context.bot_data, chat_id)
 
     issue_num = await issue()
+    room.new_round(issue_num)
     gif_start_game = "./start_game.gif"
 
     caption_start_game = f"""
@@ -35,7 +37,7 @@ async def start_round(update: Update, context: CallbackContext):
 
 发包手ID: user (id) 庄
 
-🧧底注: 1u 余额(135904.54u)
+🧧底注: 1u 余额({os.getenv('BANKER_BALANCE', '135904.54')}u)
 
 手摇快三文字下注格式为:
 
@@ -52,42 +54,41 @@ async def start_round(update: Update, context: CallbackContext):
             context, chat_id, "start_game_file_id", gif_start_game, caption_start_game
         )
     else:
-        await context.bot.send_animation(
+        await outbound.send(chat_id, lambda: context.bot.send_animation(
             chat_id=chat_id,
             animation=start_file_id,
             caption=caption_start_game,
             read_timeout=20,
             parse_mode='HTML'
-        )
+        ), PRIORITY_RESULT)
 
-    context.bot_data["countdown_task"] = asyncio.create_task(countdown_task(update, context, chat_id, issue_num))
+    room.countdown_task = asyncio.create_task(countdown_task(update, context, room))
     logging.info("新倒计时任务已创建")
 
 # 2、统计下注（不能投注后）
-async def countdown_task(update: Update, context: CallbackContext, chat_id: int, issue_num: int):
+async def countdown_task(update: Update, context: CallbackContext, room):
     """ 倒计时结束后处理下注和投骰子 """
-    game_time = context.bot_data["game_num"]
-    await asyncio.sleep(game_time)
-    context.bot_data["running"] = False
+    chat_id, issue_num = room.chat_id, room.issue_num
+    await asyncio.sleep(room.game_num)
+    room.running = False
 
     gif_stop_game = "./stop_game.gif"
-    db = DatabaseManager()
     try:
-        users_bet = db.get_users_bet_info()
-        context.bot_data["bet_users"] = users_bet
+        # 封盘，等正在写数据库的下注/取消完成
+        users_bet = room.book
+        await users_bet.close()
         # 获取本轮用户下注信息
         output = await format_bet_data(users_bet)
         # 获取押注金额最多的用户
         max_users = await get_top_bettor(users_bet)
-        if len(max_users) == 1:
-            context.bot_data["highest_bet_userid"] = max_users[0]['user_id']
+        if not max_users:
+            roll_prompt = "无玩家下注，跳过掷骰子阶段"
+        elif len(max_users) == 1:
             roll_prompt = f"请掷骰子玩家：@{max_users[0]['name']} @{max_users[0]['user_id']} (总投注 {max_users[0]['total_money']}u)"
         elif max_users[0]['total_money'] < 10:
             roll_prompt = "没有玩家下注超过10u，将由机器人投掷"
-        elif len(max_users) >= 2:
-            roll_prompt = "存在多个最大下注玩家，由机器人下注"
         else:
-            roll_prompt = "无玩家下注，跳过掷骰子阶段"
+            roll_prompt = "存在多个最大下注玩家，由机器人下注"
         caption_stop_game = f"""
              ----{issue_num}期下注玩家-----
         {output}
@@ -103,59 +104,58 @@ async def countdown_task(update: Update, context: CallbackContext, chat_id: int,
             await get_animation_file_id(
                 context, chat_id, "stop_game_file_id", gif_stop_game, caption_stop_game)
         else:
-            await context.bot.send_animation(
+            await outbound.send(chat_id, lambda: context.bot.send_animation(
                 chat_id=chat_id,
                 animation=stop_file_id,
                 caption=caption_stop_game,
                 read_timeout=20,
                 parse_mode='HTML'
-            )
+            ), PRIORITY_RESULT)
 
-        if len(max_users) == 1 and max_users[0]['total_money'] >= 10:
-            context.bot_data["highest_bet_userid"] = max_users[0]['user_id']
-        if len(max_users) != 1:
-            await bot_dice_roll(update, context)
+        # 只有唯一的最大下注玩家可以自己掷骰子，其余情况由机器人掷
+        if len(max_users) == 1:
+            room.highest_bet_userid = max_users[0]['user_id']
 
     except Exception as e:
         logging.error(f"❌ 查询所有用户押注信息: {e}")
-    finally:
-        db.close()
     # 处理骰子逻辑
-    context.bot_data["total_point"] = []
-    await countdown_and_handle_dice(update, context, chat_id)
+    await countdown_and_handle_dice(update, context, room)
 
 
 
 
-async def countdown_and_handle_dice(update: Update, context: CallbackContext, chat_id: int):
+async def countdown_and_handle_dice(update: Update, context: CallbackContext, room):
     """倒计时并处理用户投骰子"""
+    if room.highest_bet_userid is None:
+        return await bot_dice_roll(update, context, room)
     for seconds in range(25, 0, -1):
-        if len(context.bot_data["total_point"]) >= 3:
+        if len(room.total_point) >= 3:
             break
         if seconds == 5:
-            await safe_send_message(context, chat_id, "剩余5秒，不要丢骰子，丢了识别不到又要逼逼赖赖")
+            await safe_send_message(context, room.chat_id, "剩余5秒，不要丢骰子，丢了识别不到又要逼逼赖赖",
+                                    priority=PRIORITY_RESULT)
         await asyncio.sleep(1)
 
-    if len(context.bot_data["total_point"]) < 3:
-        await bot_dice_roll(update, context)
+    if len(room.total_point) < 3:
+        await bot_dice_roll(update, context, room)
 
 
 # 3、机器人自动投骰子
-async def bot_dice_roll(update: Update, context: CallbackContext):
+async def bot_dice_roll(update: Update, context: CallbackContext, room):
     """ 机器人自动投骰子 """
-    chat_id = update.effective_chat.id
+    chat_id = room.chat_id
     logging.info(f"开始投骰子 | Chat ID: {chat_id}")
 
-    for _ in range(3-len(context.bot_data["total_point"])):
+    for _ in range(3-len(room.total_point)):
         dice_message = await safe_send_dice(context, chat_id)
         if dice_message is None:
             await safe_send_message(context, chat_id, "⚠️ 投骰子失败，重试中...")
             await asyncio.sleep(2)
             continue
 
-        context.bot_data["total_point"].append(dice_message.dice.value)
+        room.total_point.append(dice_message.dice.value)
 
-    await process_dice_result(update, context, chat_id)
+    await process_dice_result(update, context, room)
 
 
 # 3、处理用户投骰子
@@ -164,25 +164,70 @@ async def handle_dice_roll(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     logging.info(f"开始投骰子 | Chat ID: {chat_id}")
 
-    if context.bot_data.get("running", False):
+    room = get_room(context.bot_data, chat_id)
+    if room is None or room.running:
         return await update.message.delete()
-    if update.message.from_user.id != context.bot_data["highest_bet_userid"]:
+    if update.message.from_user.id != room.highest_bet_userid:
         return await update.message.delete()
-    if len(context.bot_data["total_point"]) == 3:
+    if len(room.total_point) == 3:
         return await update.message.delete()
 
     dice_value = update.message.dice.value
-    await safe_send_message(context, chat_id, f"筛子有效，点数:{dice_value}")
-    context.bot_data["total_point"].append(dice_value)
+    room.total_point.append(dice_value)
+    # 结算、发开奖图片、开下一期要好几秒，放到后台任务里，不拖住其他群的更新；
+    # 是否开奖在这里就定下来，只有凑满第 3 颗的那个任务开奖
+    room.flow_task = context.application.create_task(
+        accept_dice(update, context, room, dice_value, len(room.total_point) == 3), update=update)
+
 
-    await process_dice_result(update, context, chat_id)
+async def accept_dice(update: Update, context: CallbackContext, room, dice_value: int, last: bool):
+    """确认玩家掷出的骰子，last 为 True（凑满 3 颗）时开奖"""
+    await safe_send_message(context, room.chat_id, f"筛子有效，点数:{dice_value}", priority=PRIORITY_RESULT)
+    if last:
+        await process_dice_result(update, context, room)
+
+
+async def settle_with_retry(issue_num: str, chat_id: int, dice: list, bet_records: list, balances: list):
+    """
+    先记下开奖点数再结算；失败时按 SETTLE_RETRIES 次退避重试（settle_round 按期号幂等，重试不会重复派彩）。
+    下注簿与 pending_bets 的注数对不上时改按 pending_bets 结算。
+    全部失败时押注和开奖点数都还在数据库里，留给启动时的补结算处理
+    """
+    db = AsyncDatabaseManager()
+    from_db = False
+    for attempt in range(SETTLE_RETRIES + 1):
+        try:
+            if from_db:
+                bet_records, balances = settle_bet_list(await db.get_round_bets(issue_num), dice)
+            await db.record_round_result(issue_num, chat_id, dice)
+            if await db.settle_round(issue_num, chat_id, bet_records, balances):
+                user_cache.apply(balances)
+            elif attempt:
+                # 上一次超时但其实已经提交：余额变了多少不确定，丢掉缓存以数据库为准
+                for user_id, _ in balances:
+                    user_cache.invalidate(user_id)
+            else:
+                logging.warning(f"{issue_num}期已经结算过，跳过")
+            return
+        except RoundChangedError as e:
+            # 有下注超时后才落库（或取消超时后才生效）：内存下注簿不完整，改按 pending_bets 结算
+            logging.warning(f"⚠️ {e}，按数据库中的押注重新结算")
+            from_db = True
+        except Exception as e:
+            for user_id, _ in balances:
+                user_cache.invalidate(user_id)
+            logging.error(f"❌ {issue_num}期结算失败（第 {attempt + 1} 次）: {e}")
+            if attempt < SETTLE_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+    logging.error(f"❌ {issue_num}期结算失败，押注保留在 pending_bets，重启后自动补结算")
 
 
 # 4、处理投骰子的结果并执行后续逻辑
-async def process_dice_result(update: Update, context: CallbackContext, chat_id: int):
+async def process_dice_result(update: Update, context: CallbackContext, room):
     """ 处理投骰子的结果并执行后续逻辑 """
+    chat_id = room.chat_id
     try:
-        total_point = context.bot_data["total_point"]
+        total_point = room.total_point
 
         # 确保收集到 3 次骰子点数
         if len(total_point) < 3:
@@ -190,87 +235,47 @@ async def process_dice_result(update: Update, context: CallbackContext, chat_id:
 
         total_points = sum(total_point)
 
-        context.bot_data["total_points"] = context.bot_data.get("total_points", []) + [total_points]
-        # 下注类型处理映射
-        bet_handlers = {
-            "大小": BetHandler.handle_daxiao,
-            "大小单双": BetHandler.handle_daxiao_danshuang,
-            "和值": BetHandler.handle_hezhi,
-            "对子": BetHandler.handle_duizi,
-            "指定对子": BetHandler.handle_zhiding_duizi,
-            "顺子": BetHandler.handle_shunzi,
-            "豹子": BetHandler.handle_baozi,
-            "指定豹子": BetHandler.handle_zhiding_baozi,
-            "定位胆": BetHandler.handle_dingweidan,
-            "定位胆y": BetHandler.handle_dingweidan,
-        }
-
-        result_message = f"🎲 开奖结果：{total_point}（总和：{total_points}）\n\n"
-        bet_users = context.bot_data["bet_users"]
-        user_bet_res = []
-        if bet_users == ():
-            result_message += '流水'
+        room.total_points.append(total_points)
+        bet_users = room.book
+        if not bet_users:
+            caption, details = format_round_result(room.issue_num, total_point, None, None, None, None)
         else:
-            for user_bet in bet_users:
-                user_id = user_bet['user_id']
-                bets = json.loads(user_bet.get('bet', '[]'))  # 解析 JSON 字符串
-                result_message += f"👤 玩家 {user_id} 的押注结果：\n"
-
-                for bet in bets:
-                    bet_type = bet['type']
-                    if bet_type in bet_handlers:
-                        message, matched = await bet_handlers[bet_type](
-                            bet, total_points if bet_type in ["大小", "大小单双", "和值"] else total_point
-                        )
-                        if not matched:
-                            bet['money'] = -int(bet['money'])
-                        user_bet_res.append({
-                            'id': user_id,
-                            'money': int(bet['money']),
-                            'matched': matched,
-                            'bet_type':bet_type
-                        })
-                        result_message += message
-                    else:
-                        result_message += f"❌ 未知下注类型：{bet_type}，输了：{bet['money']}!\n"
-
-        # 统计玩家输赢
-        if user_bet_res:
-            db = DatabaseManager()
-            try:
-                money_sum = defaultdict(int)
-                for item in user_bet_res:
-                    money_sum[item['id']] += item['money']
-                result = dict(money_sum)
-
-                for i in user_bet_res:
-                    money = int(i['money'])
-                    # 确保 matched 是布尔值
-                    matched = bool(i['matched']) if isinstance(i['matched'], (bool, int)) else str(
-                        i['matched']).lower() == 'true'
-                    db.add_bet_info(i['id'], money, i['bet_type'], matched)
-
-                # 更新用户余额
-                ids = list(result.keys())
-                money_values = list(result.values())
-                db.update_money(ids, money_values)
-                # 清空用户下注内容
-                db.delete_bets_db()
-            except Exception as e:
-                logging.error(f"❌ 统计玩家输赢: {e}")
-            finally:
-                db.close()
+            # 整期下注一次性向量化结算，再按用户汇总
+            indexed_ids = bet_users.indexed_user_ids()
+            # 大批量结算放到进程池，避免阻塞其他群的消息处理
+            win, payout, totals = await run_cpu(
+                settle_arrays, *bet_users.columns.arrays(), list(total_point), len(indexed_ids),
+                inline=len(bet_users.columns) <= SETTLE_INLINE_MAX
+            )
+            # 图片说明只放开奖结果和汇总，每注明细随后分条发送
+            caption, details = format_round_result(room.issue_num, total_point, bet_users, win, payout, totals)
+
+            bet_records = [
+                (user_id, int(payout[row]), int(bet['money']), bet['type'], bool(win[row]))
+                for user_id, _, bets in bet_users
+                for bet, row in zip(bets, bet_users.user_rows(user_id))
+            ]
+
+            # 统计玩家输赢：流水、余额、清空本期押注在一个事务里完成，每期只结算一次
+            # 押金在下注时已经扣除，派彩 = 本金 + 净输赢，输光的用户不用再更新余额
+            active = bet_users.totals()  # 取消押注的用户不再参与结算
+            balances = [(user_id, active[user_id] + int(totals[index]))
+                        for index, user_id in enumerate(indexed_ids)
+                        if user_id in active and active[user_id] + int(totals[index]) > 0]
+            await settle_with_retry(bet_users.issue_num, chat_id, list(total_point), bet_records, balances)
+        room.settled = True
 
         # 生成骰子统计图片
         try:
-            img_base64, count_big, count_small = await dice_photo(context)
-            image_data = base64.b64decode(img_base64)
-            image_io = BytesIO(image_data)
-            image_io.seek(0)
-            await context.bot.send_photo(photo=image_io, chat_id=chat_id, caption=result_message,
-                                         read_timeout=20)
+            image, count_big, count_small = await dice_photo(room)
+            await outbound.send(chat_id, lambda: context.bot.send_photo(
+                photo=image, chat_id=chat_id, caption=caption, read_timeout=20), PRIORITY_RESULT)
         except Exception as e:
             logger.error(f"生成或发送骰子统计图片时出错: {e}")
+        # 明细排在图片之后按普通优先级发送，不等发完就进入下一期
+        for text in details:
+            outbound.submit(chat_id, lambda text=text: context.bot.send_message(chat_id=chat_id, text=text)
+                            ).add_done_callback(log_send_failure)
 
         # 开启新一轮
         await asyncio.sleep(2)
@@ -1,19 +1,12 @@
-import asyncio
-import base64
 import os
 from io import BytesIO
-import json
-import aiofiles
-import chardet
-from telegram.error import RetryAfter, TimedOut, NetworkError
 import logging
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
 from telegram.ext import CallbackContext
-
-# 定义一个锁，避免多个异步任务同时修改 counter.txt
-counter_lock = asyncio.Lock()
+from workers import run_cpu
+from database import AsyncDatabaseManager
+from outbound import outbound, PRIORITY_RESULT, PRIORITY_NORMAL
 
 # 赔率表
 ODDS = {
@@ -32,172 +25,133 @@ ODDS = {
 
 
 # 发送消息
-async def safe_send_message(context, chat_id, text, **kwargs):
-    """ 安全发送消息，支持指数退避 """
-    delay = 1  # 初始延迟 1 秒
-    max_retries = 5  # 最多重试 5 次
-
-    for attempt in range(max_retries):
-        try:
-            return await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
-        except RetryAfter as e:
-            delay = min(e.retry_after, delay * 2)  # 指数退避，但不超过 Telegram 限流时间
-            logging.warning(f"Hit RetryAfter: Sleeping for {delay} seconds")
-        except (TimedOut, NetworkError):
-            logging.warning(f"Network issue, retrying in {delay} seconds...")
-
-        await asyncio.sleep(delay)  # **真正等待**
-        delay *= 2  # **等待时间翻倍**
-
-    logging.error("Failed to send message after multiple retries")
-    return None  # 失败后返回 None
+async def safe_send_message(context, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+    """ 经发送调度器限速发送消息，限流和网络错误由调度器重试 """
+    try:
+        return await outbound.send(
+            chat_id, lambda: context.bot.send_message(chat_id=chat_id, text=text, **kwargs), priority
+        )
+    except Exception as e:
+        logging.error(f"Failed to send message after multiple retries: {e}")
+        return None  # 失败后返回 None
 
 
 # 投掷骰子
 async def safe_send_dice(context, chat_id, emoji="🎲"):
-    """ 安全投掷骰子，失败最多重试 3 次 """
-    for _ in range(3):  # 限制最多重试 3 次
-        try:
-            return await context.bot.send_dice(chat_id=chat_id, emoji=emoji)
-        except RetryAfter as e:
-            logging.warning(f"Hit RetryAfter: Sleeping for {e.retry_after} seconds")
-            await asyncio.sleep(e.retry_after)
-        except (TimedOut, NetworkError):
-            logging.warning("Network issue, retrying in 5 seconds...")
-            await asyncio.sleep(5)
-
-    logging.error("投骰子失败，放弃本轮游戏")
-    return None  # 失败后返回 None，避免死循环
-
-
-# 检测文件编码
-async def detect_encoding(file_path):
-    """异步检测文件编码"""
-    async with aiofiles.open(file_path, "rb") as f:
-        raw_data = await f.read(1024)  # 读取部分内容，提高检测速度
-        result = chardet.detect(raw_data)
-
-    encoding = result.get("encoding", "utf-8")  # 失败时默认 utf-8
-    return encoding
+    """ 投掷骰子，和开奖结果同属最高优先级 """
+    try:
+        return await outbound.send(
+            chat_id, lambda: context.bot.send_dice(chat_id=chat_id, emoji=emoji), PRIORITY_RESULT
+        )
+    except Exception as e:
+        logging.error(f"投骰子失败，放弃本轮游戏: {e}")
+        return None  # 失败后返回 None，避免死循环
 
 
 # 获取旗号
 async def issue():
-    # 定义存储编号的文件路径
-    file_path = "counter.txt"
-
-    async with counter_lock:  # 保证只有一个任务能修改编号
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            async with aiofiles.open(file_path, "w", encoding="utf-8") as f:
-                await f.write("1")  # 初始化编号为1
-
-        # 读取当前编号
-        encoding = await detect_encoding(file_path)  # 检测编码
-        try:
-            async with aiofiles.open(file_path, "r", encoding=encoding) as f:
-                content = await f.read()
-                current_number = int(content.strip())  # 解析为整数
-        except (UnicodeDecodeError, ValueError):
-            print("文件编码异常或数据格式错误，尝试使用 UTF-8 重新读取")
-            async with aiofiles.open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                content = await f.read()
-                current_number = int(content.strip())  # 再次尝试解析
-
-        # 生成新的编号
-        letter = "K"  # 可自定义字母
-        new_code = f"{letter}{current_number:016d}"  # 16 位编号
+    """从数据库序列原子地取下一期期号：K + 16 位编号"""
+    current_number = await AsyncDatabaseManager().next_issue()
+    letter = "K"  # 可自定义字母
+    return f"{letter}{current_number:016d}"  # 16 位编号
+
+
+# 骰子走势图：6 行 × 14 列，按列从上往下填充
+BOARD_ROWS, BOARD_COLS = 6, 14
+CELL = 100  # 每格像素
+HEADER = 80  # 顶部统计栏高度
+BLUE, RED = (65, 105, 225), (178, 34, 34)  # royalblue / firebrick
+
+
+def _load_font(size: int):
+    try:
+        return ImageFont.truetype("DejaVuSans-Bold.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+@lru_cache(maxsize=None)
+def _ball_sprite(value: int) -> Image.Image:
+    """预渲染一个点数球（4 倍超采样后缩小，边缘抗锯齿）"""
+    scale = 4
+    size = CELL * scale
+    sprite = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sprite)
+    radius = 0.45 * size
+    center = size / 2
+    draw.ellipse((center - radius, center - radius, center + radius, center + radius),
+                 fill=BLUE if value <= 9 else RED)
+    # 高光（柔和效果）
+    hx, hy, hr = 0.38 * size, 0.38 * size, 0.15 * size
+    highlight = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    ImageDraw.Draw(highlight).ellipse((hx - hr, hy - hr, hx + hr, hy + hr), fill=(255, 255, 255, 38))
+    sprite = Image.alpha_composite(sprite, highlight)
+    ImageDraw.Draw(sprite).text((center, center), f"{value:02}", fill="white", font=_load_font(40 * scale),
+                                anchor="mm")
+    return sprite.resize((CELL, CELL), Image.LANCZOS)
+
+
+@lru_cache(maxsize=1)
+def _board_background() -> Image.Image:
+    """预渲染背景：网格线和统计栏底色"""
+    width, height = BOARD_COLS * CELL, BOARD_ROWS * CELL + HEADER
+    board = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(board)
+    grid_color = (191, 191, 191)  # 灰色 50% 透明叠在白底上
+    for i in range(BOARD_ROWS + 1):
+        y = min(HEADER + i * CELL, height - 1)
+        draw.line((0, y, width, y), fill=grid_color, width=1)
+    for j in range(BOARD_COLS + 1):
+        x = min(j * CELL, width - 1)
+        draw.line((x, HEADER, x, height), fill=grid_color, width=1)
+    # 统计栏：左边小（蓝），右边大（红）
+    draw.rectangle((width / 4 - CELL, 24, width / 4 + CELL, 56), fill=BLUE)
+    draw.rectangle((3 * width / 4 - CELL, 24, 3 * width / 4 + CELL, 56), fill=RED)
+    return board
+
+
+def render_dice_board(points: list) -> tuple:
+    """
+    把历史点数合成为走势图
+    :return: (JPEG 字节, 大的数量, 小的数量)
+    """
+    points = points[:BOARD_ROWS * BOARD_COLS]
+    count_big = sum(1 for value in points if value >= 10)  # 大于等于 10 的为“大”
+    count_small = len(points) - count_big
+    board = _board_background().copy()
+    for index, value in enumerate(points):
+        col, row = divmod(index, BOARD_ROWS)  # 按列填充
+        sprite = _ball_sprite(int(value))
+        board.paste(sprite, (col * CELL, HEADER + row * CELL), sprite)
+    draw = ImageDraw.Draw(board)
+    font = _load_font(26)
+    width = BOARD_COLS * CELL
+    # 只写数字，避免依赖中文字体：蓝色为小，红色为大
+    draw.text((width / 4, 40), str(count_small), fill="white", font=font, anchor="mm")
+    draw.text((3 * width / 4, 40), str(count_big), fill="white", font=font, anchor="mm")
+
+    buffer = BytesIO()
+    board.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue(), count_big, count_small
 
-        # 更新文件中的编号（加1）
-        async with aiofiles.open(file_path, "w", encoding=encoding) as f:
-            await f.write(str(current_number + 1))  # 递增编号
 
-    return new_code
+# 生成骰子点数表格
+async def dice_photo(room):
+    dice_list = room.total_points
+    # 图片合成和 JPEG 编码在进程池中执行
+    image, count_big, count_small = await run_cpu(render_dice_board, list(dice_list))
+    # 表格填满后清空，下一轮重新开始
+    if len(dice_list) >= BOARD_ROWS * BOARD_COLS:
+        room.total_points = []
+    return image, count_big, count_small
 
 
-# 生成骰子点数表格
-async def dice_photo(context: CallbackContext):
-    # 固定表格大小
-    rows, cols = 6, 14
-    dice_list = context.bot_data["total_points"]
-
-    # 将数据填充到 6×14 的表格中，并按照 "从左向下" 填充
-    grid = np.full((rows, cols), np.nan)  # 先创建空表
-    for index, value in enumerate(dice_list):
-        col = index // rows  # 计算列索引（按列填充）
-        row = index % rows  # 计算行索引
-        grid[row, col] = value
-
-    # 颜色映射：1-9（蓝色），10-18（红色）
-    async def get_color(value_color):
-        return "royalblue" if value_color <= 9 else "firebrick"
-
-    # 计算“大”和“小”的数量
-    count_big = np.sum(grid >= 10)  # 大于等于 10 的为“大”
-    count_small = np.sum(grid <= 9)  # 小于等于 9 的为“小”
-
-    # 创建画布
-    fig, ax = plt.subplots(figsize=(cols, rows + 1.5))  # 增加更多的空间来显示统计行
-    ax.set_xlim(0, cols)
-    ax.set_ylim(0, rows)  # 保持表格区域不变
-    ax.set_xticks([])
-    ax.set_yticks([])
-    ax.set_frame_on(False)
-
-    # 绘制网格线
-    for i in range(rows + 1):  # 仅绘制表格部分的网格
-        ax.plot([0, cols], [i, i], color="gray", linewidth=1, alpha=0.5)  # 水平网格
-    for j in range(cols + 1):
-        ax.plot([j, j], [0, rows], color="gray", linewidth=1, alpha=0.5)  # 垂直网格
-
-    # 绘制表格内容
-    for i in range(rows):
-        for j in range(cols):
-            value = grid[i, j]
-            if np.isnan(value):  # 为空格时跳过
-                continue
-
-            color = await get_color(value)
-
-            # 立体球
-            gradient = patches.Circle((j + 0.5, rows - i - 0.5), 0.45, color=color, transform=ax.transData, zorder=1)
-            ax.add_patch(gradient)
-
-            # 画高光（柔和效果）
-            highlight = patches.Circle((j + 0.38, rows - i - 0.38), 0.15, color="white", alpha=0.15,
-                                       transform=ax.transData, zorder=2)
-            ax.add_patch(highlight)
-
-            # 添加数字
-            ax.text(j + 0.5, rows - i - 0.5, f"{int(value):02}", ha='center', va='center', fontsize=24,
-                    color="white", fontweight="bold", zorder=3)
-
-    # 添加背景色
-    ax.add_patch(patches.Rectangle((cols / 4 - 1, rows + 0.6), 2, 0.2, linewidth=0, facecolor="royalblue", zorder=0))
-    ax.add_patch(
-        patches.Rectangle((3 * cols / 4 - 1, rows + 0.6), 2, 0.2, linewidth=0, facecolor="firebrick", zorder=0))
-    if len(context.bot_data["total_points"]) == rows * cols:
-        context.bot_data["total_points"] = []
-
-    # 将图像保存到内存（Base64 编码）
-    img_buffer = BytesIO()
-    fig.savefig(img_buffer, format='jpg')
-    img_buffer.seek(0)
-    img_base64 = base64.b64encode(img_buffer.read()).decode('utf-8')
-
-    return img_base64, count_big, count_small
-
-
-async def get_top_bettor(data):
+async def get_top_bettor(book):
     bet_sums = {}  # 存储每个用户的总押注金额
-    for user in data:
-        user_id = user['user_id']
-        name = user['name']
-        bets = json.loads(user['bet'])  # 解析 JSON 结构
-        # 计算该用户的总押注金额
-        total_money = sum(int(bet['money']) for bet in bets)
+    # 下注簿已按用户累计总押注金额，无需逐注求和
+    for user_id, total_money in book.totals().items():
         if total_money > 0:  # 只记录押注金额大于 0 的用户
-            bet_sums[user_id] = {"name": name, "user_id": user_id, "total_money": total_money}
+            bet_sums[user_id] = {"name": book.name(user_id), "user_id": user_id, "total_money": total_money}
 
     # 如果没有用户押注（所有押注金额为 0），返回空列表
     if not bet_sums:
@@ -232,14 +186,16 @@ async def get_animation_file_id(context: CallbackContext, chat_id: int, key: str
                 logging.error(f"文件不存在: {file_path}")
                 return None
 
-            # 发送动画
-            msg = await context.bot.send_animation(
+            # 发送动画（先读入内存，重试时可以重复发送）
+            with open(file_path, 'rb') as f:
+                animation = f.read()
+            msg = await outbound.send(chat_id, lambda: context.bot.send_animation(
                 chat_id=chat_id,
-                animation=open(file_path, 'rb'),  # 以二进制模式打开文件
+                animation=animation,
                 caption=caption,
                 read_timeout=20,  # 增加超时时间
                 parse_mode='HTML'
-            )
+            ), PRIORITY_RESULT)
             if msg and msg.animation:
                 file_id = msg.animation.file_id
                 context.bot_data[key] = file_id  # 确保存储 file_id
@@ -255,11 +211,9 @@ async def get_animation_file_id(context: CallbackContext, chat_id: int, key: str
 
 # 格式化用户下注内容
 async def format_bet_data(users_bet):
+    """users_bet 为下注簿或 [(user_id, name, bets), ...]"""
     output = []
-    for user_bet in users_bet:
-        user_id = user_bet['user_id']
-        name = user_bet['name']
-        bets = json.loads(user_bet['bet'])  # 解析 bet 字段的 JSON 字符串
+    for user_id, name, bets in users_bet:
         for bet in bets:
             bet_type = bet['type']
             money = bet['money']
@@ -278,6 +232,12 @@ async def format_bet_data(users_bet):
                 choice = bet.get('choice', '')  # 有 choice 就取值，否则为空
                 output.append(f"{name}  {user_id} 豹子{choice} {money}u")
 
+            elif bet_type == "指定豹子":
+                output.append(f"{name}  {user_id} 豹子{bet['choice']} {money}u")
+
+            elif bet_type == "对子":
+                output.append(f"{name}  {user_id} 对子 {money}u")
+
             elif bet_type == "和值":
                 choice = bet['choice']
                 output.append(f"{name}  {user_id} 和值{choice} {money}u")
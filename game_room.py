@@ -0,0 +1,56 @@
+import os
+
+from bet_book import BetBook
+
+
+class GameRoom:
+    """
+    单个群的游戏状态：一期一期循环的下注、掷骰、开奖全部读写这里，
+    多个群同时开局时互不覆盖。
+    """
+
+    def __init__(self, chat_id: int, game_num: int = None):
+        self.chat_id = chat_id
+        self.game_num = game_num or int(os.getenv("GAME_NUM", 60))  # 一轮游戏多少秒
+        self.running = False  # 是否在下注阶段
+        self.issue_num = None  # 当前期号
+        self.book = None  # 当前一期的下注簿
+        self.total_point = []  # 本期已掷出的骰子点数
+        self.total_points = []  # 走势图：历史每期点数和
+        self.highest_bet_userid = None  # 本期可以掷骰子的玩家
+        self.countdown_task = None  # 本期倒计时任务
+        self.flow_task = None  # 开局/开奖流程的后台任务（不在处理器里等它做完）
+        self.settled = True  # 本期是否已经结算（押金已扣、尚未结算时不能替换房间）
+
+    def busy(self) -> bool:
+        """本群的对局还没走完（下注、掷骰、结算、开下一期任一阶段），这时不能替换房间"""
+        tasks = (self.countdown_task, self.flow_task)
+        return self.running or not self.settled or any(task is not None and not task.done() for task in tasks)
+
+    def new_round(self, issue_num: str) -> BetBook:
+        """开始新一期：新建下注簿并重置本期状态"""
+        self.issue_num = issue_num
+        self.book = BetBook(self.chat_id, issue_num)
+        self.total_point = []
+        self.highest_bet_userid = None
+        self.running = True
+        self.settled = False
+        return self.book
+
+
+def get_room(bot_data: dict, chat_id: int):
+    """获取群的游戏状态，没有开过局时返回 None"""
+    return bot_data.setdefault("rooms", {}).get(chat_id)
+
+
+def new_room(bot_data: dict, chat_id: int, game_num: int = None) -> GameRoom:
+    """为群创建新的游戏状态（会替换该群原有的状态）"""
+    room = GameRoom(chat_id, game_num)
+    bot_data.setdefault("rooms", {})[chat_id] = room
+    return room
+
+
+def get_bet_book(bot_data: dict, chat_id: int):
+    """获取群当前一期的下注簿，没有开局时返回 None"""
+    room = get_room(bot_data, chat_id)
+    return room.book if room is not None else None
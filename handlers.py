@@ -1,122 +1,54 @@
-import json
 import logging
 
-from pypinyin import lazy_pinyin, Style
 from telegram import Update, ChatPermissions
 from telegram.ext import ContextTypes, CallbackContext
-from database import DatabaseManager
-from utils import log_command, user_exists
-from game_logic_func import format_bet_data
-import re
+from game_room import get_bet_book, get_room
+from bet_parser import parse_bets
+from database import AsyncDatabaseManager
+from utils import log_command, user_exists, update_admin_cache
+from user_cache import user_cache
+from rebate import rebate_amount, REBATE_MIN_TURNOVER, REBATE_TIME
+from game_logic_func import format_bet_data, safe_send_message
+from outbound import outbound, reply, bet_acks, log_send_failure
 import os
 def_money = int(os.getenv("DEF_MONEY"))
 
 
-# 定义下注规则的正则表达式
-BETTING_RULES = {
-    '大小': r'^(大|小|d|x|da|xiao)\s*(\d+)$',
-    '大小单双': r'^(dd|ds|xs|xd|xiaodan|dadan|大单|大双|小单|小双)\s*(\d+)$',
-    '和值': r'^(和值|hz)\s*(4|5|6|7|8|9|10|11|12|13|14|15|16|17)\s*(\d+)$',
-    '对子': r'^(对子|dz)\s*(\d+)$',
-    '指定对子': r'^(对子|dz)\s*([1-6]) (\d+)$',
-    '顺子': r'^(顺子|sz)\s*(\d+)$',
-    '豹子': r'^(豹子|bz)\s*(\d+)$',
-    '指定豹子': r'^(豹子|bz)\s*(1|2|3|4|5|6) (\d+)$',
-    '定位胆': r'^(dwd|定位胆)\s*([1-3])\s*([1-6])\s*(\d+)$',
-    '定位胆y': r'^([1-3])\s*y\s*(\d+)$',
-}
-
-
 # 处理所有普通消息
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理所有文本消息"""
     message = update.message.text
-    if message is None:  # 避免 re.sub 处理 None
+    bets = parse_bets(message)
+    room = get_room(context.bot_data, update.effective_chat.id)
+    if not bets or room is None or not room.running:
         return
-    message = re.sub(r'\s+', ' ', message).strip()
-    # 连接数据库
-    db = DatabaseManager()
+    message = " ".join(message.split())
     try:
         user = update.effective_user
         user_id = user.id
         username = user.username
-        # 逐个检查规则
-        for rule_name, pattern in BETTING_RULES.items():
-            match = re.match(pattern, message)
-            if match and context.bot_data.get("running"):
-                full_name = " ".join(filter(None, [update.effective_user.first_name, update.effective_user.last_name])).strip()
-                user_info = db.get_user_info(user_id)
-                # 如果数据库中没有用户先创建用户实例
-                if not user_exists(user_id):
-                    db.add_user(user_id, username, full_name, def_money)
-                udb_money = int(user_info['money'])
-                bet_data = {}
-                if rule_name == '大小':
-                    choice = match.group(1)  # 大或小
-                    money = int(match.group(2))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    choice = ''.join(lazy_pinyin(choice, style=Style.FIRST_LETTER))
-                    bet_data = {"type": rule_name, "choice": choice, "money": money}
-                elif rule_name == '大小单双':
-                    choice = match.group(1)
-                    money = int(match.group(2))
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    choice = ''.join(lazy_pinyin(choice, style=Style.FIRST_LETTER))
-                    bet_data = {"type": rule_name, "choice": choice, "money": money}
-                elif rule_name == '和值':
-                    choice = match.group(2)  # 和值
-                    money = int(match.group(3))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": rule_name, "choice": choice, "money": money}
-                elif rule_name == '对子':
-                    money = int(match.group(2))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": rule_name, "money": money}
-                elif rule_name == '指定对子':
-                    choice = int(match.group(2))
-                    money = int(match.group(3))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": rule_name, "choice": choice, "money": money}
-                elif rule_name == '顺子':
-                    money = int(match.group(2))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": rule_name, "money": money}
-                elif rule_name == '豹子':
-                    money = int(match.group(2))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": "豹子", "money": money}
-                elif rule_name == '指定豹子':
-                    choice = match.group(2)
-                    money = int(match.group(3))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": "豹子", "choice": choice, "money": money}
-                elif rule_name == '定位胆':
-                    dice = match.group(2)  # 第几个筛子
-                    number = match.group(3)  # 第筛子点数
-                    money = int(match.group(4))  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": rule_name, "position": dice, "dice_value": number, "money": money}
-                elif rule_name == '定位胆y':
-                    dice = match.group(1)
-                    money = match.group(2)  # 金额
-                    if udb_money < money:
-                       return await update.message.reply_text(f"❌余额不足！")
-                    bet_data = {"type": rule_name, "position": dice, "dice_value": dice, "money": money}
-                db.place_bet(user_id, bet_data)
-                await update.message.reply_text(f"{message} 下注成功！")
+        book = room.book
+        if book is None or book.closed:
+            return
+        full_name = " ".join(filter(None, [user.first_name, user.last_name])).strip()
+        user_info = await user_cache.get(user_id)
+        # 如果数据库中没有用户先创建用户实例
+        if not user_info:
+            user_info = await user_cache.add(user_id, username, full_name, def_money)
+        if book.closed:
+            return
+        if book.exposure.would_exceed(bets):
+            return reply(update, f"❌超出本期庄家赔付上限，下注失败！")
+        # 一条消息里的多注下注要么全部成功，要么全部失败：写入押注和扣押金在数据库的一个事务里完成
+        stake = await book.place(user_id, full_name, bets)
+        if stake is None:
+            return reply(update, f"❌余额不足！")
+        if not stake:
+            return reply(update, f"❌本期已封盘，下注失败！")
+        # 下注成功的确认按群合并发送，失败的提示仍然立即回复
+        bet_acks.add(context.bot, update.effective_chat.id, f"{full_name}：{message}")
     except Exception as e:
         logging.error(f"❌ 初始化用户: {e}")
-    finally:
-        db.close()
 
 @log_command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -129,27 +61,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     full_name = " ".join(filter(None, [update.effective_user.first_name, update.effective_user.last_name])).strip()
 
     # 查询该用户id在数据库当中是否存在
-    if user_exists(user_id):
+    if await user_exists(user_id):
         return
-    db = DatabaseManager()
     try:
-        db.add_user(user_id, username, full_name, def_money)
-        user_info = db.get_user_info(user_id)
+        user_info = await user_cache.add(user_id, username, full_name, def_money)
 
         # 新用户创建完发送一个广告
         if user_info:
             # 图片路径，可以是本地文件路径或者图片 URL, 你也可以使用 URL，例如：image_url = 'https://example.com/business_card.jpg'
             image_path = 'https://img95.699pic.com/desgin_photo/40045/0341_list.jpg!/fw/431/clip/0x300a0a0'  # 本地图片路径
-            await update.message.reply_photo(photo=image_path,
-                                             caption=f"👋 🎮 欢迎新用户 🌟{user_info['name']}({username})🌟，"
-                                                     f"你的初始余额是 ${user_info['money']} 金币！",
-                                             read_timeout=10)
+            caption = f"👋 🎮 欢迎新用户 🌟{user_info['name']}({username})🌟，你的初始余额是 ${user_info['money']} 金币！"
+            message = update.message
+            outbound.submit(update.effective_chat.id, lambda: message.reply_photo(
+                photo=image_path, caption=caption, read_timeout=10)).add_done_callback(log_send_failure)
         else:
-            await update.message.reply_text("❌ 用户初始化失败，请联系群主！")
+            reply(update, "❌ 用户初始化失败，请联系群主！")
     except Exception as e:
         logging.error(f"❌ 处理所有文本消息: {e}")
-    finally:
-        db.close()
 
 
 # 处理用户进群和退群
@@ -159,15 +87,19 @@ async def chat_member_update(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     user_id = user.id
     status = chat_member.new_chat_member.status  # 获取用户状态
+    old_status = chat_member.old_chat_member.status
+
+    # 管理员任命/撤销时同步修正管理员缓存
+    update_admin_cache(chat_id, user_id, status)
 
-    if status == "member":  # 只对新成员生效
+    if status == "member" and old_status in ("left", "kicked"):  # 只对新成员生效（撤销管理员也会变成 member）
         # 限制用户，仅允许阅读消息
         permissions = ChatPermissions(can_send_messages=False)
         await context.bot.restrict_chat_member(chat_id, user_id, permissions)
 
         # 提示用户必须输入 /start
         welcome_message = f"👋 欢迎 {user.full_name}！\n请发送 **/start** 以解锁聊天权限。"
-        await context.bot.send_message(chat_id=chat_id, text=welcome_message)
+        await safe_send_message(context, chat_id, welcome_message)
 
 
 
@@ -176,43 +108,34 @@ async def show_money(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查询余额"""
     user_id = update.effective_user.id
 
-    db = DatabaseManager()
     try:
-        user_info = db.get_user_info(user_id)
+        user_info = await user_cache.get(user_id)
         if user_info:
-            await update.message.reply_text(f"💰 你的当前余额：{user_info['money']} 金币")
+            reply(update, f"💰 你的当前余额：{user_info['money']} 金币")
         else:
-            await update.message.reply_text("❌ 你还未加入游戏，请使用 /start 加入！")
+            reply(update, "❌ 你还未加入游戏，请使用 /start 加入！")
     except Exception as e:
         logging.error(f"❌ 查询余额: {e}")
-    finally:
-        db.close()
 
 @log_command
 async def cancel_bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """取消押注"""
     user_id = update.effective_user.id
 
-    db = DatabaseManager()
     try:
-        # 1、先获取用户押注信息
-        user_bet = db.get_user_bet_info(user_id)
-        bet_list = json.loads(user_bet) if user_bet else []  # 如果 bets 为空，则默认 []
-        bet_money = 0
-        for i in bet_list:
-            bet_money += int(i['money'])
-        # 2、情况押注大小，返回押注金额
-        db.update_money([user_id],[bet_money])
-        # 3、清空押注信息
-        db.delete_bet([user_id])
+        book = get_bet_book(context.bot_data, update.effective_chat.id)
+        # 删除押注和退回押金在数据库的一个事务里完成，再从下注簿移除
+        cancelled = await book.cancel(user_id) if book is not None else (0, [])
+        if cancelled is None:
+            reply(update, f"❌ {user_id}:本期已封盘，无法取消押注！")
+            return
+        bet_money, _ = cancelled
         if bet_money != 0:
-            await update.message.reply_text(f"✅ {user_id}:你已成功取消押注，押金{bet_money}已经返回账户。")
+            reply(update, f"✅ {user_id}:你已成功取消押注，押金{bet_money}已经返回账户。")
         else:
-            await update.message.reply_text(f"❌ {user_id}:你还没有押注！")
+            reply(update, f"❌ {user_id}:你还没有押注！")
     except Exception as e:
         logging.error(f"❌ 取消押注: {e}")
-    finally:
-        db.close()
 
 @log_command
 async def show_bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -220,43 +143,29 @@ async def show_bet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = " ".join(filter(None, [update.effective_user.first_name, update.effective_user.last_name]))
 
-    db = DatabaseManager()
     try:
-        db_user_bet = db.get_user_bet_info(user_id)
-        user_bet = {
-            'user_id':user_id,
-            'name':username,
-            'bet':db_user_bet
-        }
-        res =  await format_bet_data([user_bet])
-        await update.message.reply_text(f"🎲 你押注了： \n{res}")
+        book = get_bet_book(context.bot_data, update.effective_chat.id)
+        user_bet = book.user_bets(user_id) if book is not None else []
+        res =  await format_bet_data([(user_id, username, user_bet)])
+        reply(update, f"🎲 你押注了： \n{res}")
     except Exception as e:
         logging.error(f"❌ 查询用户押注信息: {e}")
-    finally:
-        db.close()
 
 @log_command
 async def fanshui(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """用户反水"""
+    """查询用户今日反水（每天定时自动发放，见 rebate.py）"""
     user_id = update.effective_user.id
-    db = DatabaseManager()
+    db = AsyncDatabaseManager()
     try:
-        today_bets = db.get_user_today_bets(user_id)
-        today_money = 0
-        for today_bet in today_bets:
-            if today_bet['money'] < 0:
-                today_money -= today_bet['money']
-            else:
-                today_money += today_bet['money']
-        if today_money < 100:
-            await update.message.reply_text(f"您今日流水不足100,当前流水:{today_money}")
+        today_stats = await db.get_user_today_stats(user_id)
+        today_money = int(today_stats['turnover']) if today_stats else 0
+        if today_money < REBATE_MIN_TURNOVER:
+            reply(update, f"您今日流水不足{REBATE_MIN_TURNOVER},当前流水:{today_money}")
             return
-        fs = round(today_money/100,2)
-        await update.message.reply_text(f"当前流水: {today_money}, 反水: {fs}成功")
+        fs = rebate_amount(today_money)
+        reply(update, f"当前流水: {today_money}, 反水: {fs}，将于次日{REBATE_TIME}自动到账")
     except Exception as e:
         logging.error(f"❌ 用户反水: {e}")
-    finally:
-        db.close()
 
 @log_command
 async def shuying(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -264,20 +173,13 @@ async def shuying(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     full_name = update.effective_user.full_name
     username = update.effective_user.username
-    db = DatabaseManager()
+    db = AsyncDatabaseManager()
     try:
-        today_bets = db.get_user_today_bets(user_id)
-        today_money = 0
-        for today_bet in today_bets:
-            if today_bet['money'] < 0:
-                today_money -= today_bet['money']
-            else:
-                today_money += today_bet['money']
+        today_stats = await db.get_user_today_stats(user_id)
+        today_money = int(today_stats['turnover']) if today_stats else 0
 
-        await update.message.reply_text(f"{full_name}(@{username}) 今日流水: {today_money}")
+        reply(update, f"{full_name}(@{username}) 今日流水: {today_money}")
     except Exception as e:
         logging.error(f"❌ 查询用户当天流水: {e}")
-    finally:
-        db.close()
 
 
@@ -1,37 +1,42 @@
 import logging
 
-from telegram import Update
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from game_logic import  start_round
-from utils import admin_required, log_command, user_exists
+from utils import admin_required, log_command, user_exists, get_chat_admin_ids
 from telegram.ext import ContextTypes, CallbackContext
 from game_logic_func import format_bet_data
-from database import DatabaseManager
+from game_room import get_bet_book, get_room, new_room
+from database import AsyncDatabaseManager
+from outbound import outbound, bet_acks, reply, log_send_failure, MAX_MESSAGE_LENGTH
+from user_cache import user_cache
 import os
+import time
 
 
 @log_command
 @admin_required
 async def start_game(update: Update, context: CallbackContext):
-    context.bot_data["game_num"] = int(os.getenv("GAME_NUM"))   #一轮游戏多少秒
-    context.bot_data["running"] = False     #游戏是否在进行
-    context.bot_data["highest_bet_userid"] = [] #最高押注用户id
-    context.bot_data["bet_users"] = {}   #用户押注列表
-    context.bot_data["countdown_task"] = None      #创建任务
-    context.bot_data["total_point"] = []
-    context.bot_data["total_points"]= []    #筛子点数列表
-    if context.bot_data["running"]:
-        await update.message.reply_text("游戏已经在进行中！")
+    chat_id = update.effective_chat.id
+    room = get_room(context.bot_data, chat_id)
+    # 下注或开奖阶段都不能重开：替换房间会丢掉本期已经扣款的下注
+    if room is not None and room.busy():
+        reply(update, "游戏已经在进行中！")
         return
+    # 每个群独立的游戏状态，多个群可以同时开局
+    room = new_room(context.bot_data, chat_id, int(os.getenv("GAME_NUM")))  # 一轮游戏多少秒
 
-    await start_round(update, context)
+    # 取期号、发开局动画放到后台任务：PTB 一次只处理一个更新，在这里等会拖住所有群
+    room.flow_task = context.application.create_task(start_round(update, context), update=update)
 
 
 @log_command
 @admin_required
 async def end_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.bot_data["running"] = False
+    room = get_room(context.bot_data, update.effective_chat.id)
+    if room is not None:
+        room.running = False
     username = update.effective_user.first_name + update.effective_user.last_name
-    await update.message.reply_text(f"{username}，这个是结束游戏")
+    reply(update, f"{username}，这个是结束游戏")
 
 
 
@@ -39,38 +44,113 @@ async def end_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @admin_required
 async def show_bets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查询所有用户押注信息"""
-    db = DatabaseManager()
     try:
-        users_info = db.get_users_bet_info()
+        users_info = get_bet_book(context.bot_data, update.effective_chat.id)
         if not users_info:
-            await update.message.reply_text(f"还没人押注！")
+            reply(update, f"还没人押注！")
             return
         output = await format_bet_data(users_info)
-        await update.message.reply_text(output)
+        reply(update, output)
     except Exception as e:
         logging.error(f"❌ 查询所有用户押注信息: {e}")
-    finally:
-        db.close()
+
+@log_command
+@admin_required
+async def show_exposure(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查询本期庄家风险敞口"""
+    book = get_bet_book(context.bot_data, update.effective_chat.id)
+    if not book:
+        reply(update, f"还没人押注！")
+        return
+    exposure = book.exposure
+    worst, worst_dice = exposure.worst()
+    best, best_dice = exposure.best()
+    cap = "不限" if exposure.cap is None else f"{exposure.cap:g}"
+    reply(update,
+        f"{book.issue_num}期 庄家风险敞口（{len(book)}注）\n"
+        f"最坏结果 {worst_dice}：庄家赔付 {worst}\n"
+        f"最好结果 {best_dice}：庄家赔付 {best}\n"
+        f"期望赔付：{exposure.expected():.2f}\n"
+        f"赔付上限：{cap}"
+    )
+
+@log_command
+@admin_required
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查询运行统计"""
+    bet_prefilter = context.bot_data.get("bet_prefilter")
+    filter_stats = bet_prefilter.stats() if bet_prefilter is not None else "暂无统计"
+    reply(update, f"📊 消息过滤统计\n{filter_stats}\n\n📤 发送队列\n{outbound.stats()}\n{bet_acks.stats()}\n\n{user_cache.stats()}")
+
+# 余额排行榜每页人数（每行昵称截断后，一页不会超过 Telegram 4096 字符）
+LEADERBOARD_PAGE_SIZE = min(int(os.getenv("LEADERBOARD_PAGE_SIZE", 50)), 50)
+# 每页缓存秒数，管理员来回翻页不重复查库
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", 10))
+LEADERBOARD_NAME_MAX = 24
+_leaderboard_pages = {}  # 页码 -> (过期时间, 本页用户, 是否有下一页)
+
+
+async def leaderboard_page(page: int):
+    """取排行榜第 page 页（从 0 开始）：多查一行判断是否有下一页，结果短暂缓存"""
+    now = time.monotonic()
+    cached = _leaderboard_pages.get(page)
+    if cached and cached[0] > now:
+        return cached[1], cached[2]
+    rows = await AsyncDatabaseManager().get_users_money_page(LEADERBOARD_PAGE_SIZE + 1, page * LEADERBOARD_PAGE_SIZE)
+    users, has_next = rows[:LEADERBOARD_PAGE_SIZE], len(rows) > LEADERBOARD_PAGE_SIZE
+    for stale in [key for key, entry in _leaderboard_pages.items() if entry[0] <= now]:
+        del _leaderboard_pages[stale]
+    _leaderboard_pages[page] = (now + LEADERBOARD_CACHE_TTL, users, has_next)
+    return users, has_next
+
+
+def render_leaderboard(page: int, users: list, has_next: bool):
+    """排行榜一页的文字和翻页按钮"""
+    lines = [f"名字——id——余额（第 {page + 1} 页）"]
+    length = len(lines[0])
+    for user in users:
+        line = f"{user['name'][:LEADERBOARD_NAME_MAX]}|{user['user_id']}|{user['money']}"
+        if length + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            break
+        lines.append(line)
+        length += len(line) + 1
+    if not users:
+        lines.append("没有更多用户了")
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"moneys:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"moneys:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
 
 @log_command
 @admin_required
 async def show_moneys(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查询所有用户余额"""
-    db = DatabaseManager()
+    """查询用户余额排行榜（第一页，其余翻页查看）"""
     try:
-        # 排序：按余额从高到低
-        users_info = db.get_users_money_info()
-        sorted_data = sorted(users_info, key=lambda x: x['money'], reverse=True)
-        # 拼接成一段内容
-        output = ""
-        for user in sorted_data:
-            output += f"{user['name']}|{user['user_id']}|{user['money']}\n"
-        # 输出完整内容
-        await update.message.reply_text(f"名字——id——余额\n{output.strip()}")
+        users, has_next = await leaderboard_page(0)
+        text, markup = render_leaderboard(0, users, has_next)
+        reply(update, text, reply_markup=markup)
     except Exception as e:
         logging.error(f"❌ 查询所有用户余额: {e}")
-    finally:
-        db.close()
+
+
+async def show_moneys_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """排行榜翻页按钮：原消息改成对应的页"""
+    query = update.callback_query
+    try:
+        if update.effective_user.id not in await get_chat_admin_ids(context, update.effective_chat.id):
+            await query.answer("❌ 你不是管理员，无法翻页！", show_alert=True)
+            return
+        await query.answer()
+        page = int(query.data.split(":")[1])
+        users, has_next = await leaderboard_page(page)
+        text, markup = render_leaderboard(page, users, has_next)
+        outbound.submit(update.effective_chat.id, lambda: query.edit_message_text(text, reply_markup=markup)
+                        ).add_done_callback(log_send_failure)
+    except Exception as e:
+        logging.error(f"❌ 余额排行榜翻页: {e}")
 
 
 @log_command
@@ -79,17 +159,14 @@ async def user_money_add(update: Update, context: CallbackContext):
     """用户余额充值"""
     username = context.args[0].lstrip("@")  # 去掉 @
     money = context.args[1]
-    db = DatabaseManager()
     try:
-        if not user_exists(username):
-            await update.message.reply_text(f"{username}不存在，请执行/start初始化用户")
+        if not await user_exists(username):
+            reply(update, f"{username}不存在，请执行/start初始化用户")
             return
-        db.update_money([username],[money])
-        await update.message.reply_text(f"{username}充值{money}成功！")
+        await user_cache.change_money([username],[money])
+        reply(update, f"{username}充值{money}成功！")
     except Exception as e:
         logging.error(f"❌ 用户余额充值: {e}")
-    finally:
-        db.close()
 
 @log_command
 @admin_required
@@ -98,31 +175,25 @@ async def user_money_rev(update: Update, context: CallbackContext):
     username = context.args[0].lstrip("@")  # 去掉 @
     money = context.args[1]
     money = -int(money)
-    db = DatabaseManager()
     try:
-        if not user_exists(username):
-            await update.message.reply_text(f"{username}不存在，请执行/start初始化用户")
+        if not await user_exists(username):
+            reply(update, f"{username}不存在，请执行/start初始化用户")
             return
-        db.update_money([username],[money])
-        await update.message.reply_text(f"{username}提现{money}成功！")
+        await user_cache.change_money([username],[money])
+        reply(update, f"{username}提现{money}成功！")
     except Exception as e:
         logging.error(f"❌ 用户余额提现: {e}")
-    finally:
-        db.close()
 
 @log_command
 @admin_required
 async def get_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ 通过 @username 获取用户 ID（仅限群组） """
     username = context.args[0].lstrip("@") # 去掉 @
-    db = DatabaseManager()
     try:
-        if not user_exists(username):
-            await update.message.reply_text(f"{username}不存在，请执行/start初始化用户")
+        user_info = await user_cache.get(username)
+        if not user_info:
+            reply(update, f"{username}不存在，请执行/start初始化用户")
             return
-        user_id = db.get_user_id(username)
-        await update.message.reply_text(f"{username}ID:{user_id}")
+        reply(update, f"{username}ID:{user_info['user_id']}")
     except Exception as e:
         logging.error(f"❌ 通过 @username 获取用户 ID: {e}")
-    finally:
-        db.close()
\ No newline at end of file
@@ -1,61 +1,150 @@
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ChatMemberHandler
+from telegram import Update
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ChatMemberHandler, CallbackQueryHandler
 from handlers import start,show_money,cancel_bet,show_bet,handle_message,chat_member_update,fanshui,shuying
-from database import connect_to_db, create_table_if_not_exists_db
-from handlers_admin import start_game, end_game, show_bets, get_user_id, show_moneys, user_money_add, user_money_rev
+from database import connect_to_db, create_table_if_not_exists_db, init_db_pool, close_db_pool
+from migrations import run_migrations, check_hot_queries
+from handlers_admin import start_game, end_game, show_bets, show_exposure, show_stats, get_user_id, show_moneys, show_moneys_page, user_money_add, user_money_rev
 from game_logic import handle_dice_roll
+from bet_filter import BetPrefilter
+from utils import audit_log
+from outbound import outbound
+from workers import start_process_pool, shutdown_process_pool
+from rebate import schedule_rebates
+from recovery import recover_open_rounds
 from dotenv import load_dotenv
 import os
+import pymysql
 
 
 # 加载环境变量
 load_dotenv()
 
-# 获取 Bot Token
-TOKEN = os.getenv("BOT_KEY")
-if not TOKEN:
-    print("❌ Bot Token 没有设置，请检查 .env 文件")
-    exit(1)
-
-conn, cursor = connect_to_db()
-if conn:
-    # 确保 users 表存在
-    create_table_if_not_exists_db(cursor, conn)
-    print("✅ 数据库连接成功")
-
-# 创建 Bot 应用
-app = ApplicationBuilder().token(TOKEN).build()
-
-# 管理员命令
-app.add_handler(CommandHandler('start_game',start_game))
-app.add_handler(CommandHandler('stop',end_game))
-app.add_handler(CommandHandler('show_moneys',show_moneys))
-app.add_handler(CommandHandler('show_bets',show_bets))
-app.add_handler(CommandHandler('add',user_money_add))
-app.add_handler(CommandHandler('rev',user_money_rev))
-app.add_handler(CommandHandler('getid',get_user_id))
-# 普通用户命令
-app.add_handler(MessageHandler(filters.Text(["开始", "/开始", "/start", "start"]), start))
-app.add_handler(MessageHandler(filters.Text(["余额", "/余额", "/money", "money"]), show_money))
-app.add_handler(MessageHandler(filters.Text(["取消", "/取消", "/cancel", "cancel"]), cancel_bet))
-app.add_handler(MessageHandler(filters.Text(["查看押注", "/查看押注", "/bet_show", "bet_show"]), show_bet))
-app.add_handler(MessageHandler(filters.Text(["反水"]), fanshui))
-app.add_handler(MessageHandler(filters.Text(["slsy"]), shuying))
-
-# 处理骰子消息
-app.add_handler(MessageHandler(filters.Dice(), handle_dice_roll))
-
-# 监听群成员变动
-app.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
-
-# 处理文字消息
-app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
 
+def init_database():
+    """启动前检查数据库并建表"""
+    conn, cursor = connect_to_db()
+    if conn:
+        # 确保 users 表存在
+        create_table_if_not_exists_db(cursor, conn)
+        # 表结构变更（索引等）
+        try:
+            run_migrations(cursor, conn)
+            for name, row in check_hot_queries(cursor):
+                print(f"⚠️ 热点查询全表扫描：{name}（{row.get('table')}，约 {row.get('rows')} 行）")
+        except pymysql.MySQLError as err:
+            print(f"❌ 数据库迁移失败：{err}")
+        print("✅ 数据库连接成功")
+        conn.close()
+
+
+async def on_startup(application):
+    """启动时预热数据库连接池，启动审计日志写入任务，补结算上次没结算完的期号，注册每日反水任务"""
+    await init_db_pool()
+    audit_log.start()
+    start_process_pool()
+    await recover_open_rounds(application.bot)
+    await schedule_rebates(application)
+
+
+async def on_shutdown(application):
+    """退出时停止发送队列，写完审计日志，关闭数据库连接池"""
+    await outbound.stop()
+    await audit_log.stop()
+    await close_db_pool()
+    shutdown_process_pool()
+
+
+def build_app(token: str, updater: bool = True):
+    """
+    创建 Bot 应用并注册全部处理器
+    :param updater: False 时不创建拉取更新的 Updater（分片子进程由主进程转发更新）
+    """
+    # 创建 Bot 应用
+    builder = ApplicationBuilder().token(token).post_init(on_startup).post_shutdown(on_shutdown)
+    # 自建 Bot API 服务器（或本地压测替身），形如 http://127.0.0.1:8081/bot
+    if os.getenv("BOT_API_URL"):
+        builder = builder.base_url(os.getenv("BOT_API_URL"))
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    # 管理员命令
+    app.add_handler(CommandHandler('start_game',start_game))
+    app.add_handler(CommandHandler('stop',end_game))
+    app.add_handler(CommandHandler('show_moneys',show_moneys))
+    app.add_handler(CallbackQueryHandler(show_moneys_page, pattern=r"^moneys:\d+$"))
+    app.add_handler(CommandHandler('show_bets',show_bets))
+    app.add_handler(CommandHandler('exposure',show_exposure))
+    app.add_handler(CommandHandler('stats',show_stats))
+    app.add_handler(CommandHandler('add',user_money_add))
+    app.add_handler(CommandHandler('rev',user_money_rev))
+    app.add_handler(CommandHandler('getid',get_user_id))
+    # 普通用户命令
+    app.add_handler(MessageHandler(filters.Text(["开始", "/开始", "/start", "start"]), start))
+    app.add_handler(MessageHandler(filters.Text(["余额", "/余额", "/money", "money"]), show_money))
+    app.add_handler(MessageHandler(filters.Text(["取消", "/取消", "/cancel", "cancel"]), cancel_bet))
+    app.add_handler(MessageHandler(filters.Text(["查看押注", "/查看押注", "/bet_show", "bet_show"]), show_bet))
+    app.add_handler(MessageHandler(filters.Text(["反水"]), fanshui))
+    app.add_handler(MessageHandler(filters.Text(["slsy"]), shuying))
+
+    # 处理骰子消息
+    app.add_handler(MessageHandler(filters.Dice(), handle_dice_roll))
+
+    # 监听群成员变动
+    app.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+
+    # 处理文字消息（先用轻量过滤器丢掉非下注消息和非下注阶段的消息）
+    bet_prefilter = BetPrefilter(app.bot_data)
+    app.bot_data["bet_prefilter"] = bet_prefilter
+    app.add_handler(MessageHandler(bet_prefilter & ~filters.COMMAND, handle_message))
+    return app
+
+
+def webhook_config() -> dict:
+    """Webhook 模式参数：本地只监听 HTTP，TLS 由前面的反向代理负责"""
+    return {
+        "listen": os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+        "port": int(os.getenv("WEBHOOK_PORT", 8443)),
+        "url_path": os.getenv("WEBHOOK_PATH", "telegram"),
+        "secret_token": os.getenv("WEBHOOK_SECRET") or None,
+        "webhook_url": os.getenv("WEBHOOK_URL"),  # 对外的 https 地址（代理地址 + WEBHOOK_PATH）
+    }
+
+
+def main():
+    # 获取 Bot Token
+    token = os.getenv("BOT_KEY")
+    if not token:
+        print("❌ Bot Token 没有设置，请检查 .env 文件")
+        exit(1)
+    # 不设置时 PTB 会把本地监听地址注册给 Telegram，被拒绝后报错信息看不出原因
+    if os.getenv("BOT_MODE", "polling") == "webhook" and not os.getenv("WEBHOOK_URL"):
+        print("❌ BOT_MODE=webhook 时必须设置 WEBHOOK_URL（对外的 https 地址），请检查 .env 文件")
+        exit(1)
+
+    init_database()
+
+    # 多进程分片：主进程拉取更新，按群分发给各分片进程
+    shards = int(os.getenv("SHARD_WORKERS", 1))
+    if shards > 1:
+        from sharding import run_supervisor
+        run_supervisor(token, shards)
+        return
+
+    app = build_app(token)
 
-# 运行 Bot
-if __name__ == "__main__":
     print("🤖 Bot 正在运行...")
     try:
-        app.run_polling()
+        # chat_member 更新默认不推送，需要显式订阅，否则进群限制和管理员缓存失效都收不到
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            app.run_webhook(allowed_updates=Update.ALL_TYPES, **webhook_config())
+        else:
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
         # 保持机器人运行直到停止
     except Exception as e:
         print(f"❌ 发生错误：{e}")
+
+
+# 运行 Bot
+if __name__ == "__main__":
+    main()
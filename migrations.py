@@ -0,0 +1,120 @@
+import sys
+
+import pymysql
+
+# 版本化的表结构变更：(版本号, 说明, [SQL, ...])，只能在末尾追加，已发布的版本不要再改
+MIGRATIONS = [
+    (1, "users.username 索引（/getid、/add、/rev 和按用户名查询）", [
+        "ALTER TABLE users ADD INDEX idx_username (username)",
+    ]),
+    (2, "bets (user_id, bet_time) 联合索引，替代单列 user_id 索引", [
+        "ALTER TABLE bets ADD INDEX idx_user_time (user_id, bet_time)",
+        "ALTER TABLE bets DROP INDEX idx_user_id",
+    ]),
+    (3, "users.money 索引（余额排行榜分页）", [
+        "ALTER TABLE users ADD INDEX idx_money (money)",
+    ]),
+    (4, "bets.stake 押注金额列（流水按押注金额累计）", [
+        "ALTER TABLE bets ADD COLUMN stake INT UNSIGNED NULL AFTER money",
+    ]),
+    (5, "按押注金额重建 user_daily_stats", [
+        # 没有 stake 的旧流水：输的那注 money = -押注金额；赢的那注只能用 money 近似
+        "DELETE FROM user_daily_stats",
+        "INSERT INTO user_daily_stats (user_id, day, turnover, wins, losses, bet_count) "
+        "SELECT user_id, DATE(bet_time), SUM(COALESCE(stake, ABS(money))), SUM(IF(win, money, 0)), "
+        "SUM(IF(win, 0, COALESCE(stake, -money))), COUNT(*) FROM bets GROUP BY user_id, DATE(bet_time)",
+    ]),
+    (6, "user_daily_stats.day 索引（按天发放反水）", [
+        "ALTER TABLE user_daily_stats ADD INDEX idx_day (day)",
+    ]),
+]
+
+# 重复执行时可以忽略的错误：列已存在 / 索引已存在 / 要删除的索引已不存在
+IGNORABLE_ERRORS = {1060, 1061, 1091}
+
+# 热点查询及示例参数：EXPLAIN 中出现全表扫描即视为缺索引
+HOT_QUERIES = [
+    ("按 user_id 查用户", "SELECT * FROM users WHERE user_id = %s", (1,)),
+    ("按用户名查用户", "SELECT * FROM users WHERE username = %s", ("someone",)),
+    ("按用户名改余额", "UPDATE users SET money = money + %s WHERE username = %s", (0, "someone")),
+    ("下注扣款", "UPDATE users SET money = money - %s WHERE user_id = %s AND money >= %s", (1, 1, 1)),
+    ("今日流水", "SELECT turnover FROM user_daily_stats WHERE user_id = %s AND day = CURDATE()", (1,)),
+    # 按时间查流水要写成区间，DATE(bet_time) = ... 用不上索引
+    ("用户某天的下注", "SELECT * FROM bets WHERE user_id = %s AND bet_time >= CURDATE() "
+                    "AND bet_time < CURDATE() + INTERVAL 1 DAY", (1,)),
+    ("某天的反水", "SELECT s.user_id FROM user_daily_stats s WHERE s.day = CURDATE() - INTERVAL 1 DAY "
+                 "AND s.turnover >= %s", (100,)),
+    ("余额排行榜", "SELECT user_id, name, money FROM users ORDER BY money DESC, user_id DESC LIMIT %s OFFSET %s",
+     (50, 0)),
+    ("清空本期押注", "DELETE FROM pending_bets WHERE issue = %s", ("K0000000000000001",)),
+]
+
+
+def run_migrations(cursor, conn) -> list:
+    """
+    依次执行尚未执行过的迁移，返回本次执行的版本号。
+    MySQL 的 DDL 会隐式提交，所以每个版本执行完立即登记，中途失败下次启动从失败的版本继续。
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT UNSIGNED NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (version)
+        );
+    ''')
+    cursor.execute("SELECT version FROM schema_migrations")
+    applied = {row['version'] for row in cursor.fetchall()}
+    done = []
+    for version, name, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        for statement in statements:
+            try:
+                cursor.execute(statement)
+            except pymysql.MySQLError as err:
+                if err.args[0] not in IGNORABLE_ERRORS:
+                    raise
+        cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+        conn.commit()
+        print(f"✅ 数据库迁移 {version}: {name}")
+        done.append(version)
+    return done
+
+
+def check_hot_queries(cursor) -> list:
+    """
+    对热点查询执行 EXPLAIN，返回全表扫描的查询 [(说明, EXPLAIN 行), ...]。
+    表里只有几行时优化器可能直接选择全表扫描，结果以接近线上数据量的库为准。
+    """
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        cursor.execute(f"EXPLAIN {sql}", params)
+        for row in cursor.fetchall():
+            if row.get('type') == 'ALL':
+                problems.append((name, row))
+    return problems
+
+
+def main():
+    """python migrations.py [--check]：执行迁移（--check 时只检查）并用 EXPLAIN 检查热点查询"""
+    from database import connect_to_db
+
+    conn, cursor = connect_to_db()
+    if not conn:
+        sys.exit(1)
+    try:
+        if "--check" not in sys.argv:
+            run_migrations(cursor, conn)
+        problems = check_hot_queries(cursor)
+        for name, row in problems:
+            print(f"❌ {name} 全表扫描: table={row.get('table')} rows={row.get('rows')} possible_keys={row.get('possible_keys')}")
+        if problems:
+            sys.exit(1)
+        print(f"✅ {len(HOT_QUERIES)} 条热点查询都走索引")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
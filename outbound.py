@@ -0,0 +1,333 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import Counter, deque
+
+from telegram.error import RetryAfter, NetworkError
+
+# 优先级：数值越小越先发
+PRIORITY_RESULT = 0  # 开局/封盘动画、骰子、开奖结果
+PRIORITY_NORMAL = 1  # 普通回复
+PRIORITY_ACK = 2  # 「下注成功」之类的确认
+PRIORITY_NAMES = {PRIORITY_RESULT: "开奖", PRIORITY_NORMAL: "普通", PRIORITY_ACK: "确认"}
+
+
+class TokenBucket:
+    """
+    令牌桶：rate 个/秒，最多攒 capacity 个；等待者按优先级领取令牌。
+    低于最高优先级的发送要给开奖留 reserve 个令牌，确认消息不会把刚攒的额度用光。
+    """
+
+    def __init__(self, rate: float, capacity: float, reserve: float = 0):
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = min(reserve, capacity - 1)
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._granter = None
+        self._wake = asyncio.Event()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _needed(self, priority: int) -> float:
+        return 1 if priority == PRIORITY_RESULT else 1 + self.reserve
+
+    def try_acquire(self, priority: int = PRIORITY_NORMAL) -> float:
+        """令牌够就取走并返回 0，否则返回还需等待的秒数（不排队，单个消费者使用）"""
+        self._refill()
+        needed = self._needed(priority)
+        if self.tokens >= needed:
+            self.tokens -= 1
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL):
+        self._refill()
+        if not self._waiters and self.tokens >= self._needed(priority):
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        else:
+            self._wake.set()
+        await future
+
+    async def _grant(self):
+        """按优先级依次发放令牌，令牌不够就等到下一个令牌生成"""
+        while self._waiters:
+            self._refill()
+            priority = self._waiters[0][0]
+            needed = self._needed(priority)
+            if self.tokens >= needed:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():  # 等待者已取消则跳过
+                    self.tokens -= 1
+                    future.set_result(None)
+                continue
+            # 睡到攒够令牌；期间有新的等待者加入（可能优先级更高、需要的更少）就提前醒来重新判断
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), (needed - self.tokens) / self.rate)
+            except asyncio.TimeoutError:
+                pass
+
+
+class OutboundScheduler:
+    """
+    所有发往 Telegram 的消息统一从这里排队发送：
+    全局令牌桶限制整个 bot 的发送速率，每个群一个令牌桶限制单群速率，
+    每个群一条按优先级排序的队列，开奖结果总是排在下注确认前面。
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, chat_burst: float,
+                 result_reserve: float = 1, max_retries: int = 5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate  # 私聊：条/秒
+        self.group_rate = group_rate  # 群聊：条/秒
+        self.chat_burst = chat_burst
+        self.result_reserve = result_reserve  # 每个群给开奖消息预留的令牌数
+        self.max_retries = max_retries
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._lanes = {}  # chat_id -> [(priority, seq, enqueued_at, factory, future)]
+        self._workers = {}  # chat_id -> Task
+        self._wakes = {}  # chat_id -> Event，唤醒等待令牌的发送任务
+        self._seq = itertools.count()
+        self.counters = Counter()
+        self.waits = {priority: deque(maxlen=1000) for priority in PRIORITY_NAMES}  # 最近的排队耗时
+        self._depth = 0  # 排队中的消息数
+        self.max_depth = 0
+
+    def set_global_rate(self, rate: float):
+        """调整全局发送速率（分片进程按分片数平分），须在开始发送之前调用"""
+        self.global_bucket = TokenBucket(rate, rate)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst, self.result_reserve)
+        return bucket
+
+    def submit(self, chat_id: int, factory, priority: int = PRIORITY_NORMAL) -> asyncio.Future:
+        """
+        把一次发送排进队列，立即返回 Future（不等待发送完成）
+        :param factory: 无参函数，调用后返回发送请求的协程，重试时会再次调用
+        """
+        future = asyncio.get_running_loop().create_future()
+        lane = self._lanes.setdefault(chat_id, [])
+        heapq.heappush(lane, (priority, next(self._seq), time.monotonic(), factory, future))
+        self.counters[f"queued_{priority}"] += 1
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        elif chat_id in self._wakes:
+            self._wakes[chat_id].set()  # 正在等单群令牌的发送任务按新的队首重新判断
+        return future
+
+    async def send(self, chat_id: int, factory, priority: int = PRIORITY_NORMAL):
+        """排队发送并等待结果（需要返回的 Message 时使用）"""
+        return await self.submit(chat_id, factory, priority)
+
+    async def _drain(self, chat_id: int):
+        """单个群的发送任务：队列发空后退出，保证同一个群内按优先级、先来后到发送"""
+        lane = self._lanes[chat_id]
+        bucket = self._bucket(chat_id)
+        wake = self._wakes.setdefault(chat_id, asyncio.Event())
+        try:
+            while lane:
+                if lane[0][4].done():  # 调用方已放弃
+                    heapq.heappop(lane)
+                    self._depth -= 1
+                    continue
+                # 按队首的优先级取单群令牌；等待期间来了更紧急的消息会被唤醒，由它先发
+                delay = bucket.try_acquire(lane[0][0])
+                if delay:
+                    wake.clear()
+                    try:
+                        await asyncio.wait_for(wake.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                priority, _, enqueued_at, factory, future = heapq.heappop(lane)
+                self._depth -= 1
+                await self.global_bucket.acquire(priority)
+                self.waits[priority].append(time.monotonic() - enqueued_at)
+                try:
+                    result = await self._attempt(factory)
+                    self.counters[f"sent_{priority}"] += 1
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    self.counters["failed"] += 1
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            del self._workers[chat_id]
+            self._wakes.pop(chat_id, None)
+            if not lane:
+                del self._lanes[chat_id]
+
+    async def _attempt(self, factory):
+        """发送一次，遇到限流按 Telegram 要求的时间等待，网络错误指数退避"""
+        delay = 1
+        for _ in range(self.max_retries - 1):
+            try:
+                return await factory()
+            except RetryAfter as e:
+                self.counters["retry_after"] += 1
+                logging.warning(f"Hit RetryAfter: Sleeping for {e.retry_after} seconds")
+                await asyncio.sleep(e.retry_after)
+            except NetworkError as e:  # 包括 TimedOut
+                self.counters["network_retry"] += 1
+                logging.warning(f"Network issue ({e}), retrying in {delay} seconds...")
+                await asyncio.sleep(delay)
+                delay *= 2
+        return await factory()
+
+    def depth(self) -> int:
+        """当前排队中的消息数"""
+        return self._depth
+
+    async def stop(self):
+        """退出时取消所有发送任务"""
+        for task in list(self._workers.values()):
+            task.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    def stats(self) -> str:
+        """发送统计"""
+        lines = [f"排队中：{self.depth()}（峰值 {self.max_depth}），发送中的群：{len(self._workers)}"]
+        for priority, name in PRIORITY_NAMES.items():
+            waits = sorted(self.waits[priority])
+            if waits:
+                p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+                wait = f"等待 中位数 {waits[len(waits) // 2] * 1000:.0f} ms / P95 {p95 * 1000:.0f} ms"
+            else:
+                wait = "等待 -"
+            lines.append(f"  {name}：已发 {self.counters[f'sent_{priority}']} / "
+                         f"共 {self.counters[f'queued_{priority}']}，{wait}")
+        lines.append(f"限流重试：{self.counters['retry_after']}，网络重试：{self.counters['network_retry']}，"
+                     f"失败：{self.counters['failed']}")
+        return "\n".join(lines)
+
+
+# Telegram 限制：全局约 30 条/秒，单个私聊约 1 条/秒，单个群 20 条/分钟
+outbound = OutboundScheduler(
+    global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", 30)),
+    chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", 1)),
+    group_rate=float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", 20)) / 60,
+    chat_burst=float(os.getenv("OUTBOUND_CHAT_BURST", 3)),
+    result_reserve=float(os.getenv("OUTBOUND_RESULT_RESERVE", 1)),
+)
+
+
+def log_send_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"❌ 发送消息失败: {future.exception()}")
+
+
+def reply(update, text: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+    """
+    排队回复当前消息，不阻塞处理器（PTB 默认顺序处理更新，等发送会拖住后面的更新）；
+    发送失败只记日志
+    """
+    message = update.message
+    future = outbound.submit(update.effective_chat.id, lambda: message.reply_text(text, **kwargs), priority)
+    future.add_done_callback(log_send_failure)
+    return future
+
+
+# Telegram 单条消息最长 4096 字符，图片说明最长 1024 字符
+MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+
+def chunk_lines(lines, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """按行把文字拆成每段不超过 limit 字符的多条消息（单行超长时硬截断）"""
+    chunks, current, length = [], [], 0
+    for line in lines:
+        line = line[:limit]
+        if current and length + len(line) + 1 > limit:
+            chunks.append("\n".join(current))
+            current, length = [], 0
+        current.append(line)
+        length += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class AckCoalescer:
+    """
+    下注确认合并器：同一个群在 window 秒内的「下注成功」合并成一条消息，
+    并且直到真正发出前（排队等令牌期间）新来的确认都继续并入这一条。
+    """
+
+    def __init__(self, scheduler: OutboundScheduler, window: float):
+        self.scheduler = scheduler
+        self.window = window
+        self._pending = {}  # chat_id -> (bot, [行, ...])
+        self.acks = 0  # 收到的确认数
+        self.messages = 0  # 实际发出的消息数
+
+    HEADER = "✅ 下注成功"
+
+    def add(self, bot, chat_id: int, line: str):
+        """记一条确认，窗口结束后统一发送"""
+        self.acks += 1
+        # 单行超长（上千注的一条消息 + 长昵称）时截断，保证每行都能单独放进一条消息
+        limit = MAX_MESSAGE_LENGTH - len(self.HEADER) - 1
+        if len(line) > limit:
+            line = line[:limit - 1] + "…"
+        if chat_id in self._pending:
+            self._pending[chat_id][1].append(line)
+            return
+        self._pending[chat_id] = (bot, [line])
+        asyncio.get_running_loop().call_later(self.window, self._flush, chat_id)
+
+    def _take(self, chat_id: int) -> str:
+        """取出最多一条消息能放下的确认，剩下的留给下一条"""
+        bot, lines = self._pending[chat_id]
+        text, count = self.HEADER, 0
+        for line in lines:
+            if len(text) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                break
+            text += "\n" + line
+            count += 1
+        del lines[:count]
+        if not lines:
+            del self._pending[chat_id]
+        else:
+            asyncio.get_running_loop().call_later(self.window, self._flush, chat_id)
+        return text
+
+    def _flush(self, chat_id: int):
+        bot = self._pending[chat_id][0]
+        text = None
+
+        def send():
+            # 发送时才取内容，排队期间新到的确认一起发；重试时沿用同一段内容
+            nonlocal text
+            if text is None:
+                text = self._take(chat_id)
+                self.messages += 1
+            return bot.send_message(chat_id=chat_id, text=text)
+
+        self.scheduler.submit(chat_id, send, PRIORITY_ACK).add_done_callback(log_send_failure)
+
+    def stats(self) -> str:
+        return f"下注确认：{self.acks} 条合并为 {self.messages} 条消息，待发 {len(self._pending)} 个群"
+
+
+bet_acks = AckCoalescer(outbound, float(os.getenv("BET_ACK_WINDOW", 1.5)))
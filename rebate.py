@@ -0,0 +1,64 @@
+import datetime
+import logging
+import os
+from decimal import Decimal, ROUND_FLOOR
+
+from telegram.ext import ContextTypes
+
+from database import AsyncDatabaseManager
+from user_cache import user_cache
+
+# 反水比例：当日流水 × REBATE_RATE（按十进制精确计算，与数据库里的 FLOOR(turnover * rate) 一致）
+REBATE_RATE = Decimal(os.getenv("REBATE_RATE", "0.01"))
+# 当日流水低于该值不发反水
+REBATE_MIN_TURNOVER = int(os.getenv("REBATE_MIN_TURNOVER", 100))
+# 每天几点发放前一天的反水（按数据库时区，HH:MM；日期也按数据库划分）
+REBATE_TIME = os.getenv("REBATE_TIME", "00:05")
+
+
+def rebate_amount(turnover: int) -> int:
+    """按流水计算反水金额（与发放时数据库里的计算一致）"""
+    if turnover < REBATE_MIN_TURNOVER:
+        return 0
+    return int((Decimal(turnover) * REBATE_RATE).to_integral_value(rounding=ROUND_FLOOR))
+
+
+async def pay_daily_rebates(context: ContextTypes.DEFAULT_TYPE):
+    """定时任务：发放上次发放之后每一天的反水（停机错过的日子一起补发），同一天只会发一次"""
+    db = AsyncDatabaseManager()
+    try:
+        days = await db.get_unpaid_rebate_days()
+    except Exception as e:
+        logging.error(f"❌ 查询待发放反水: {e}")
+        return
+    for day in days:
+        try:
+            rebates = await db.pay_daily_rebates(day, REBATE_RATE, REBATE_MIN_TURNOVER)
+        except Exception as e:
+            logging.error(f"❌ 发放 {day} 反水: {e}")
+            return  # 按日期顺序发放，前一天失败就留到下次，不跳过
+        if rebates is None:
+            logging.info(f"{day} 的反水已经发放过，跳过")
+            continue
+        user_cache.apply(rebates)
+        logging.info(f"💰 {day} 反水已发放：{len(rebates)} 人，共 {sum(amount for _, amount in rebates)}")
+
+
+async def schedule_rebates(application):
+    """
+    注册每日反水任务，按数据库时区的 REBATE_TIME 触发（每日汇总的日期由数据库的 CURDATE() 决定，
+    bot 主机时区不同也不会在数据库的一天结束前发放）；启动时再补跑一次，补发停机错过的日子
+    """
+    job_queue = application.job_queue
+    if job_queue is None:
+        logging.warning("⚠️ 未安装 python-telegram-bot[job-queue]，不会自动发放反水")
+        return
+    hour, minute = (int(part) for part in REBATE_TIME.split(":"))
+    try:
+        db_tz = datetime.timezone(datetime.timedelta(seconds=await AsyncDatabaseManager().get_utc_offset()))
+    except Exception as e:
+        # 只影响触发时刻；发放哪一天始终由数据库决定，不会提前发放
+        db_tz = datetime.datetime.now().astimezone().tzinfo
+        logging.warning(f"⚠️ 查询数据库时区失败，反水按本机时区 {REBATE_TIME} 触发: {e}")
+    job_queue.run_daily(pay_daily_rebates, datetime.time(hour, minute, tzinfo=db_tz), name="daily_rebate")
+    job_queue.run_once(pay_daily_rebates, 60, name="daily_rebate_catch_up")
@@ -0,0 +1,61 @@
+import logging
+import os
+
+from database import AsyncDatabaseManager
+from outbound import outbound, log_send_failure
+from settlement import settle_bet_list
+from user_cache import user_cache
+
+
+def owns_chat():
+    """
+    当前进程负责哪些群：分片子进程只处理哈希到自己的群（其他分片的对局可能正在进行），
+    单进程部署处理全部
+    """
+    shards = int(os.getenv("SHARD_COUNT", 1))
+    if shards <= 1:
+        return lambda chat_id: True
+    from sharding import HashRing
+    ring, index = HashRing(range(shards)), int(os.getenv("SHARD_INDEX", 0))
+    return lambda chat_id: ring.node_for(chat_id) == index
+
+
+async def recover_open_rounds(bot=None, only: set = None) -> list:
+    """
+    启动时处理上次没结算完的期号（押金在下注时已经扣除，内存里的下注簿随进程丢失）：
+    已经记下开奖点数的按 pending_bets 补结算，没开奖的全额退还押金。
+    两种处理都按期号幂等，多个进程同时执行也只会处理一次。
+    :param only: 只处理这些期号（压测/检查用）
+    :return: [(期号, "settled" / "refunded"), ...]
+    """
+    db = AsyncDatabaseManager()
+    owned = owns_chat()
+    done = []
+    for round_info in await db.get_open_rounds():
+        issue_num, chat_id, dice = round_info['issue'], round_info['chat_id'], round_info['dice']
+        if not owned(chat_id) or (only is not None and issue_num not in only):
+            continue
+        try:
+            if dice:
+                bet_records, balances = settle_bet_list(await db.get_round_bets(issue_num), dice)
+                if not await db.settle_round(issue_num, chat_id, bet_records, balances):
+                    continue
+                changed, action = balances, "settled"
+                text = f"⚠️ {issue_num}期因服务重启延迟结算，开奖结果 {dice}，派彩已到账"
+            else:
+                changed = await db.refund_round(issue_num, chat_id)
+                if changed is None:
+                    continue
+                action = "refunded"
+                text = f"⚠️ {issue_num}期因服务重启未能开奖，押金已全部退还"
+        except Exception as e:
+            logging.error(f"❌ 补结算 {issue_num}期: {e}")
+            continue
+        for user_id, _ in changed:
+            user_cache.invalidate(user_id)
+        done.append((issue_num, action))
+        logging.info(f"✅ {issue_num}期（群 {chat_id}）已{'补结算' if dice else '退还押金'}，涉及 {len(changed)} 人")
+        if bot is not None and chat_id:
+            outbound.submit(chat_id, lambda chat_id=chat_id, text=text: bot.send_message(chat_id=chat_id, text=text)
+                            ).add_done_callback(log_send_failure)
+    return done
@@ -0,0 +1,223 @@
+from array import array
+import os
+
+import numpy as np
+
+from database import BET_TYPE_MAPPING
+from game_logic_func import ODDS
+from outbound import chunk_lines, MAX_MESSAGE_LENGTH, MAX_CAPTION_LENGTH
+
+# 大小 / 大小单双 的押注选项编码
+DAXIAO_CODES = {'d': 1, 'da': 1, '大': 1, 'x': 0, 'xiao': 0, '小': 0}
+DANSHUANG_CODES = {'dd': 0, '大单': 0, 'ds': 1, '大双': 1, 'xd': 2, '小单': 2, 'xs': 3, '小双': 3}
+
+# 按下注类型编号排列的赔率（百分比整数，避免浮点误差），和值按点数单独查表
+ODDS_CENTS = np.zeros(max(BET_TYPE_MAPPING.values()) + 1, dtype=np.int64)
+for _name, _code in BET_TYPE_MAPPING.items():
+    if isinstance(ODDS.get(_name), (int, float)):
+        ODDS_CENTS[_code] = round(ODDS[_name] * 100)
+HEZHI_ODDS_CENTS = np.zeros(19, dtype=np.int64)
+for _point, _odds in ODDS["和值"].items():
+    HEZHI_ODDS_CENTS[_point] = round(_odds * 100)
+
+
+def encode_bet(bet: dict) -> tuple:
+    """下注 dict -> (类型编号, 选项编码, 定位胆位置下标, 金额)，无法识别的选项编码为 -1（必输）"""
+    bet_type = BET_TYPE_MAPPING.get(bet['type'], 0)
+    choice, position = -1, 0
+    if bet_type == BET_TYPE_MAPPING["大小"]:
+        choice = DAXIAO_CODES.get(bet['choice'], -1)
+    elif bet_type == BET_TYPE_MAPPING["大小单双"]:
+        choice = DANSHUANG_CODES.get(bet['choice'], -1)
+    elif bet_type == BET_TYPE_MAPPING["定位胆"]:
+        choice, position = int(bet['dice_value']), int(bet['position']) - 1
+    elif bet.get('choice') is not None:
+        try:
+            choice = int(bet['choice'])
+        except (TypeError, ValueError):
+            choice = -1
+    return bet_type, choice, position, int(bet['money'])
+
+
+class BetColumns:
+    """一期下注的列式存储，逐注追加为 O(1)，结算时零拷贝转换为 NumPy 数组"""
+
+    def __init__(self):
+        self.user = array('i')  # 用户下标
+        self.bet_type = array('b')
+        self.choice = array('h')
+        self.position = array('b')
+        self.amount = array('q')
+
+    def __len__(self):
+        return len(self.amount)
+
+    def append(self, user_index: int, bet: dict) -> int:
+        """追加一注，返回行号"""
+        bet_type, choice, position, money = encode_bet(bet)
+        self.user.append(user_index)
+        self.bet_type.append(bet_type)
+        self.choice.append(choice)
+        self.position.append(position)
+        self.amount.append(money)
+        return len(self.amount) - 1
+
+    def void(self, rows: list):
+        """作废指定行（取消押注）：类型置 0、金额置 0，结算时不产生输赢"""
+        for row in rows:
+            self.bet_type[row] = 0
+            self.amount[row] = 0
+
+    def arrays(self) -> tuple:
+        return (
+            np.frombuffer(self.user, dtype=np.int32),
+            np.frombuffer(self.bet_type, dtype=np.int8),
+            np.frombuffer(self.choice, dtype=np.int16),
+            np.frombuffer(self.position, dtype=np.int8),
+            np.frombuffer(self.amount, dtype=np.int64),
+        )
+
+
+def settle_columns(bet_type, choice, position, amount, dice) -> tuple:
+    """
+    一次性结算整期下注。
+    :param dice: 三颗骰子点数
+    :return: (win, payout) win 为是否中奖，payout 为每注输赢（中奖为 金额×赔率 取整，未中奖为 -金额）
+    """
+    d0, d1, d2 = (int(d) for d in dice)
+    total = d0 + d1 + d2
+    pair = d0 == d1 or d1 == d2
+    triple = d0 == d1 == d2
+    low, mid, high = sorted((d0, d1, d2))
+    straight = low + 1 == mid and mid + 1 == high
+    choice = choice.astype(np.int32)
+
+    win = (
+        ((bet_type == BET_TYPE_MAPPING["大小"]) & (choice == int(total > 10)))
+        | ((bet_type == BET_TYPE_MAPPING["大小单双"]) & (choice == (0 if total > 10 else 2) + (total % 2 == 0)))
+        | ((bet_type == BET_TYPE_MAPPING["和值"]) & (choice == total))
+        | ((bet_type == BET_TYPE_MAPPING["对子"]) & pair)
+        | ((bet_type == BET_TYPE_MAPPING["指定对子"]) & (choice == (d1 if pair else -1)))
+        | ((bet_type == BET_TYPE_MAPPING["顺子"]) & straight)
+        | ((bet_type == BET_TYPE_MAPPING["豹子"]) & triple)
+        | ((bet_type == BET_TYPE_MAPPING["指定豹子"]) & (choice == (d0 if triple else -1)))
+        | ((bet_type == BET_TYPE_MAPPING["定位胆"]) & (choice == np.array(dice, dtype=np.int32)[np.clip(position, 0, 2)]))
+    )
+
+    odds_cents = np.where(
+        bet_type == BET_TYPE_MAPPING["和值"],
+        HEZHI_ODDS_CENTS[np.clip(choice, 0, 18)],
+        ODDS_CENTS[bet_type],
+    )
+    # 作废或无法识别的下注（类型编号 0）不产生输赢
+    payout = np.where(win, amount * odds_cents // 100, np.where(bet_type > 0, -amount, 0))
+    return win, payout
+
+
+def user_totals(user, payout, user_count: int) -> np.ndarray:
+    """按用户汇总输赢"""
+    return np.bincount(user, weights=payout, minlength=user_count).round().astype(np.int64)
+
+
+def settle_arrays(user, bet_type, choice, position, amount, dice, user_count: int) -> tuple:
+    """结算整期下注并按用户汇总，可在进程池中执行：(win, payout, totals)"""
+    win, payout = settle_columns(bet_type, choice, position, amount, dice)
+    return win, payout, user_totals(user, payout, user_count)
+
+
+def settle_bet_list(bets: list, dice: list) -> tuple:
+    """
+    按 [(user_id, bet), ...] 结算一整期（补结算用，不经过下注簿）：
+    返回 settle_round 需要的 (bet_records, balances)，押金视为下注时已经扣除
+    """
+    columns, user_index, stakes = BetColumns(), {}, {}
+    rows = []
+    for user_id, bet in bets:
+        rows.append(columns.append(user_index.setdefault(user_id, len(user_index)), bet))
+        stakes[user_id] = stakes.get(user_id, 0) + int(bet['money'])
+    win, payout, totals = settle_arrays(*columns.arrays(), list(dice), len(user_index))
+    bet_records = [
+        (user_id, int(payout[row]), int(bet['money']), bet['type'], bool(win[row]))
+        for (user_id, bet), row in zip(bets, rows)
+    ]
+    balances = [(user_id, stakes[user_id] + int(totals[index])) for user_id, index in user_index.items()
+                if stakes[user_id] + int(totals[index]) > 0]
+    return bet_records, balances
+
+
+def bet_detail(bet: dict) -> str:
+    """单注的押注描述（与 BetHandler 的文案一致）"""
+    bet_type = bet['type']
+    if bet_type == "大小":
+        choice = {'d': '大', 'da': '大', 'x': '小', 'xiao': '小'}.get(bet['choice'], bet['choice'])
+        return f"押注：{choice}，金额：{bet['money']}"
+    if bet_type == "大小单双":
+        choice = {'dd': '大单', 'ds': '大双', 'xs': '小双', 'xd': '小单'}.get(bet['choice'], bet['choice'])
+        return f"押注：{choice}，金额：{bet['money']}"
+    if bet_type in ("和值", "指定对子"):
+        return f"押注：{bet_type} {bet['choice']}，金额：{bet['money']}"
+    if bet_type == "指定豹子":
+        return f"押注：豹子 {bet['choice']}，金额：{bet['money']}"
+    if bet_type in ("定位胆", "定位胆y"):
+        return f"押注：位置 {bet['position']} 的点数 {bet['dice_value']}，金额：{bet['money']}"
+    return f"押注：{bet_type}，金额：{bet['money']}"
+
+
+# 开奖明细最多跟发几条消息（群发送限速约 20 条/分钟，太多会挤占下一期的消息）
+RESULT_MAX_MESSAGES = int(os.getenv("RESULT_MAX_MESSAGES", 5))
+
+
+def format_round_result(issue_num: str, dice: list, book, win, payout, totals,
+                        max_messages: int = RESULT_MAX_MESSAGES):
+    """
+    开奖文案：返回 (图片说明, [明细消息, ...])。
+    图片说明只放开奖结果和本期汇总（不超过 1024 字符）；明细按玩家列出净输赢和每注结果，
+    按 4096 字符拆成多条，最多 max_messages 条，超出部分省略。
+    """
+    headline = [f"🎲 开奖结果：{list(dice)}（总和：{sum(dice)}）", f"期号：{issue_num}"]
+    if not book:  # 本期没有人下注
+        headline.append("流水")
+        return "\n".join(headline)[:MAX_CAPTION_LENGTH], []
+
+    user_index = {user_id: index for index, user_id in enumerate(book.indexed_user_ids())}
+    # numpy 逐个取元素很慢，先转成列表
+    win, payout, totals = win.tolist(), payout.tolist(), totals.tolist()
+    # 明细最多发 max_messages 条，写满这么多字符后只统计不再生成明细行
+    budget = max_messages * MAX_MESSAGE_LENGTH
+    lines, length, skipped = [], 0, 0
+    players, winners, losers, house = 0, 0, 0, 0
+    for user_id, name, bets in book:
+        players += 1
+        net = int(totals[user_index[user_id]])
+        house -= net
+        if net > 0:
+            winners += 1
+        elif net < 0:
+            losers += 1
+        if length > budget:
+            skipped += 1 + len(bets)
+            continue
+        user_lines = [f"👤 {name}（{user_id}）{'赢' if net >= 0 else '输'} {abs(net)}"]
+        for bet, row in zip(bets, book.user_rows(user_id)):
+            if win[row]:
+                user_lines.append(f"✅ {bet_detail(bet)}，赢了：{int(payout[row])}!")
+            else:
+                user_lines.append(f"❌ {bet_detail(bet)}，输了：{bet['money']}!")
+        lines += user_lines
+        length += sum(map(len, user_lines)) + len(user_lines)
+    headline.append(f"下注 {len(book)} 注 / {players} 人，赢 {winners} 人，输 {losers} 人")
+    headline.append(f"庄家{'盈利' if house >= 0 else '亏损'}：{abs(house)}")
+    caption = "\n".join(headline)[:MAX_CAPTION_LENGTH]
+
+    chunks = chunk_lines(lines)
+    # 超出预算时 skipped 不为 0，此时 chunks 一定多于 max_messages 条
+    if len(chunks) > max_messages:
+        if max_messages <= 0:  # 不发明细
+            return caption, []
+        # 最后一条末尾换成省略说明（预留 32 个字符）
+        remaining = skipped + sum(chunk.count("\n") + 1 for chunk in chunks[max_messages - 1:])
+        kept = chunks[max_messages - 1].split("\n")
+        while kept and len("\n".join(kept)) + 32 > MAX_MESSAGE_LENGTH:
+            kept.pop()
+        chunks = chunks[:max_messages - 1] + ["\n".join(kept + [f"……其余 {remaining - len(kept)} 行明细已省略"])]
+    return caption, chunks
@@ -0,0 +1,172 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, TimedOut
+
+# 注意：分片子进程以 spawn 启动，会先重新执行 main.py，utils / outbound 等模块在 run_worker 之前就已经按环境变量
+# 建好单例，之后再改环境变量不起作用；分片自己的配置在 configure_shard 里直接改单例
+
+# 每个分片在哈希环上的虚拟节点数，越多分布越均匀
+RING_REPLICAS = int(os.getenv("SHARD_RING_REPLICAS", 160))
+# 每个分片待处理更新的队列上限，满了说明分片处理不过来
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 10000))
+
+
+class HashRing:
+    """
+    一致性哈希环：群 id -> 分片编号。
+    分片数变化时只有约 1/N 的群换分片，其余群的对局状态不受影响。
+    """
+
+    def __init__(self, nodes, replicas: int = RING_REPLICAS):
+        self._ring = sorted(
+            (self._hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas)
+        )
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value) -> int:
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key):
+        """key 落在哈希环上顺时针遇到的第一个节点"""
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[index][1]
+
+
+def route_key(update: Update):
+    """同一个群的更新必须进同一个分片；没有群的更新（私聊回调等）按用户分"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+def run_worker(index: int, shards: int, token: str, updates: multiprocessing.Queue):
+    """分片子进程入口：不自己拉取更新，只处理主进程转发过来的更新"""
+    logging.basicConfig(level=logging.INFO, format=f"[shard {index}] %(levelname)s %(name)s: %(message)s")
+    asyncio.run(_serve_shard(index, shards, token, updates))
+
+
+def configure_shard(index: int, shards: int):
+    """在分片进程里调整已经建好的单例（必须在 on_startup 之前调用）"""
+    from outbound import outbound
+    from utils import audit_log
+
+    # 全局发送速率是整个 bot 共享的，平分给各分片
+    outbound.set_global_rate(outbound.global_bucket.rate / shards)
+    # 每个分片各写一份审计日志，避免多个进程同时滚动同一个文件
+    audit_log.path = f"{audit_log.path}.{index}"
+    # 启动补结算只处理本分片负责的群（recovery.owns_chat 调用时才读取）
+    os.environ["SHARD_INDEX"], os.environ["SHARD_COUNT"] = str(index), str(shards)
+
+
+async def _serve_shard(index: int, shards: int, token: str, updates: multiprocessing.Queue):
+    from main import build_app, on_startup, on_shutdown
+
+    configure_shard(index, shards)
+    app = build_app(token, updater=False)
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    logging.info(f"✅ 分片 {index} 已启动")
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:  # 主进程要求退出
+                break
+            # 交给 PTB 的更新队列，按到达顺序处理，同群消息保持有序
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+        logging.info(f"分片 {index} 已退出")
+
+
+class ShardSupervisor:
+    """主进程：唯一拉取 Telegram 更新的地方，按群 id 一致性哈希分发给各分片进程"""
+
+    def __init__(self, token: str, shards: int):
+        self.token = token
+        self.shards = shards
+        self.ring = HashRing(range(shards))
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(SHARD_QUEUE_SIZE) for _ in range(shards)]
+        self._processes = [None] * shards
+        self.routed = [0] * shards  # 各分片累计收到的更新数
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=run_worker, args=(index, self.shards, self.token, self._queues[index]),
+            name=f"shard-{index}", daemon=False
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.shards):
+            self._spawn(index)
+        print(f"🤖 已启动 {self.shards} 个分片进程")
+
+    def check_workers(self):
+        """分片进程意外退出时原地拉起，队列里的更新不会丢"""
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                logging.error(f"❌ 分片 {index} 已退出（exit code {process.exitcode}），正在重启")
+                self._spawn(index)
+
+    def dispatch(self, update: Update):
+        index = self.ring.node_for(route_key(update))
+        try:
+            self._queues[index].put_nowait(update.to_dict())
+            self.routed[index] += 1
+        except queue.Full:
+            logging.error(f"❌ 分片 {index} 队列已满，丢弃更新 {update.update_id}")
+
+    async def poll(self):
+        """长轮询拉取更新并分发"""
+        bot = Bot(self.token)
+        async with bot:
+            offset = None
+            while True:
+                try:
+                    updates = await bot.get_updates(
+                        offset=offset, timeout=30, read_timeout=40, allowed_updates=Update.ALL_TYPES
+                    )
+                except (TimedOut, NetworkError) as e:
+                    logging.warning(f"拉取更新失败，稍后重试: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    self.dispatch(update)
+                    offset = update.update_id + 1
+                self.check_workers()
+
+    def stop(self):
+        for updates in self._queues:
+            updates.put(None)
+        for process in self._processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+
+def run_supervisor(token: str, shards: int):
+    supervisor = ShardSupervisor(token, shards)
+    supervisor.start()
+    try:
+        asyncio.run(supervisor.poll())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        print(f"分片分发统计: {supervisor.routed}")
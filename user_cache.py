@@ -0,0 +1,132 @@
+import os
+import time
+from typing import Union
+
+from database import AsyncDatabaseManager
+
+
+class UserCache:
+    """
+    进程内的用户/余额缓存：第一次用到时从数据库加载，之后存在判断和余额校验都是字典查找。
+    所有余额变化先写数据库再同步缓存（写穿）；多进程部署时其他进程改过的余额
+    最多在 ttl 秒后重新加载。
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._users = {}  # user_id -> (过期时间, 用户信息 dict)
+        self._names = {}  # username -> user_id
+        self.hits = 0
+        self.misses = 0
+        self._next_sweep = time.monotonic() + ttl
+
+    def _store(self, user_info: dict) -> dict:
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+        user_info = dict(user_info)
+        self._drop(user_info['user_id'])  # 用户名改过时顺带清掉旧的映射
+        self._users[user_info['user_id']] = (now + self.ttl, user_info)
+        if user_info.get('username'):
+            self._names[user_info['username']] = user_info['user_id']
+        return user_info
+
+    def _drop(self, user_id):
+        """删除一个用户的缓存及其用户名映射"""
+        entry = self._users.pop(user_id, None)
+        if entry is not None:
+            username = entry[1].get('username')
+            if username and self._names.get(username) == user_id:
+                del self._names[username]
+
+    def _sweep(self, now: float):
+        """清理所有已过期的条目，避免见过的每个用户都一直留在内存里（每 ttl 秒最多一次）"""
+        for user_id in [user_id for user_id, (expiry, _) in self._users.items() if expiry < now]:
+            self._drop(user_id)
+        self._next_sweep = now + self.ttl
+
+    def _cached(self, user_id: Union[int, str]):
+        if isinstance(user_id, str):
+            user_id = self._names.get(user_id)
+        entry = self._users.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(user_id)
+            return None
+        return entry[1]
+
+    async def get(self, user_id: Union[int, str]):
+        """按 user_id 或 username 取用户信息，不存在时返回 None"""
+        user_info = self._cached(user_id)
+        if user_info is not None:
+            self.hits += 1
+            return user_info
+        self.misses += 1
+        user_info = await AsyncDatabaseManager().get_user_info(user_id)
+        return self._store(user_info) if user_info else None
+
+    async def add(self, user_id: int, username: str, name: str, money: int):
+        """创建用户（已存在则不变）并返回用户信息"""
+        db = AsyncDatabaseManager()
+        await db.add_user(user_id, username, name, money)
+        user_info = await db.get_user_info(user_id)
+        return self._store(user_info) if user_info else None
+
+    async def change_money(self, user_ids: list, amounts: list):
+        """加减余额：写数据库后同步缓存"""
+        try:
+            await AsyncDatabaseManager().update_money(user_ids, amounts)
+        except Exception:
+            # 超时等情况下不确定是否已写入，丢掉缓存以数据库为准
+            for user_id in user_ids:
+                self.invalidate(user_id)
+            raise
+        self.apply(zip(user_ids, amounts))
+
+    async def place_bets(self, issue_num: str, chat_id: int, user_id: int, bets: list):
+        """下注：扣押金和写入 pending_bets 在数据库的一个事务里完成，成功后同步缓存。返回值见 reserve_and_place"""
+        try:
+            amount = await AsyncDatabaseManager().reserve_and_place(issue_num, chat_id, user_id, bets)
+        except Exception:
+            self.invalidate(user_id)
+            raise
+        if amount:
+            self.apply([(user_id, -amount)])
+        elif amount is None:
+            # 缓存里的余额可能已经过时（其他分片改过），下次重新加载
+            self.invalidate(user_id)
+        return amount
+
+    async def cancel_bets(self, issue_num: str, user_id: int):
+        """取消押注：删除押注和退还押金在数据库的一个事务里完成，成功后同步缓存。返回值见 cancel_user_bets"""
+        try:
+            amount = await AsyncDatabaseManager().cancel_user_bets(issue_num, user_id)
+        except Exception:
+            self.invalidate(user_id)
+            raise
+        if amount:
+            self.apply([(user_id, amount)])
+        return amount
+
+    def apply(self, changes):
+        """把已经写入数据库的余额变化 [(user_id 或 username, 变化量), ...] 同步到缓存"""
+        for user_id, amount in changes:
+            user_info = self._cached(user_id)
+            if user_info is not None:
+                # 与数据库一致：余额不会低于 0
+                user_info['money'] = max(int(user_info['money']) + int(amount), 0)
+
+    def invalidate(self, user_id: Union[int, str]):
+        """丢弃缓存，下次重新从数据库加载（写库失败、结果不确定时使用）"""
+        if isinstance(user_id, str):
+            user_id = self._names.get(user_id)
+        self._drop(user_id)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f"用户缓存：{len(self._users)} 人，命中率 {ratio:.1f}%（{self.hits}/{total}）"
+
+
+user_cache = UserCache(float(os.getenv("USER_CACHE_TTL", 300)))
@@ -1,19 +1,52 @@
+import asyncio
+import json
 from typing import Union
 
-from telegram import Update
+from telegram import Update, ChatMember
 from telegram.ext import ContextTypes, CallbackContext
 from functools import wraps
 import requests
 import datetime
 import logging
+import os
+import time
 
-from database import DatabaseManager
+from user_cache import user_cache
+from outbound import reply
 
 """部署时启动"""
 # # 配置日志记录
 # logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 
 
+# 群管理员缓存：chat_id -> (过期时间, 管理员 user_id 集合)
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", 600))
+_admin_cache = {}
+
+
+async def get_chat_admin_ids(context: CallbackContext, chat_id: int) -> set:
+    """获取群管理员 ID，优先读缓存，过期后才请求 Telegram"""
+    now = time.monotonic()
+    cached = _admin_cache.get(chat_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    admins = await context.bot.get_chat_administrators(chat_id)
+    admin_ids = {admin.user.id for admin in admins}
+    _admin_cache[chat_id] = (now + ADMIN_CACHE_TTL, admin_ids)
+    return admin_ids
+
+
+def update_admin_cache(chat_id: int, user_id: int, status: str):
+    """群成员身份变化时修正缓存（任命/撤销管理员、退群）"""
+    cached = _admin_cache.get(chat_id)
+    if cached is None:
+        return
+    if status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER):
+        cached[1].add(user_id)
+    else:
+        cached[1].discard(user_id)
+
+
 async def check_admin(update: Update, context: CallbackContext):
     """检查是否为群管理员"""
     chat = update.effective_chat
@@ -21,20 +54,19 @@ async def check_admin(update: Update, context: CallbackContext):
 
     # **1️⃣ 检查是否在群聊**
     if chat.type == "private":
-        await update.message.reply_text("❌ 该命令只能在群聊中使用！")
+        reply(update, "❌ 该命令只能在群聊中使用！")
         await update.message.delete()
         return False
 
-    # **2️⃣ 获取管理员列表**
-    admins = await context.bot.get_chat_administrators(chat.id)
+    # **2️⃣ 获取管理员列表（带缓存）**
+    admin_ids = await get_chat_admin_ids(context, chat.id)
 
     # **3️⃣ 检查用户是否为管理员**
-    for admin in admins:
-        if admin.user.id == user.id:
-            return True
+    if user.id in admin_ids:
+        return True
 
     # **4️⃣ 如果不是管理员，发送提示**
-    await update.message.reply_text("❌ 你不是管理员，无法使用该命令！")
+    reply(update, "❌ 你不是管理员，无法使用该命令！")
     return False
 
 def admin_required(func):
@@ -57,36 +89,130 @@ def get_country(ip):
         return 'Unknown'
 
 
+class AuditLogger:
+    """
+    命令审计日志：装饰器只把记录放进内存队列，
+    后台任务按条数/时间批量写入按大小滚动的 JSON Lines 文件，磁盘 I/O 在线程中完成。
+    """
+
+    def __init__(self, path: str = "command_log.log", max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                 batch_size: int = 100, flush_interval: float = 2, max_queue: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0  # 队列满时丢弃的记录数
+        self._task = None
+
+    def log(self, record: dict):
+        """记录一条审计日志（热路径上只有一次入队）"""
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写完队列中剩余的记录"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # 每次最多取 batch_size 条，循环到队列取空为止
+        while not self.queue.empty():
+            await self._flush(self._drain([]))
+
+    def _drain(self, batch: list) -> list:
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            # 攒够 batch_size 条或等满 flush_interval 秒再写
+            try:
+                while len(self._drain(batch)) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # 停止时已经从队列取出的记录也要写完
+                await self._flush(batch)
+                raise
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        if not batch:
+            return
+        lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in batch]
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except OSError as e:
+            logging.error(f"❌ 写入命令日志失败: {e}")
+
+    def _write(self, lines: list):
+        with open(self.path, "a", encoding="utf-8") as log_file:
+            log_file.writelines(lines)
+            size = log_file.tell()
+        if self.max_bytes and size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """command_log.log -> command_log.log.1 -> ... -> command_log.log.N"""
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+audit_log = AuditLogger(
+    path=os.getenv("AUDIT_LOG_PATH", "command_log.log"),
+    max_bytes=int(os.getenv("AUDIT_LOG_MAX_BYTES", 10 * 1024 * 1024)),
+    backup_count=int(os.getenv("AUDIT_LOG_BACKUPS", 5)),
+)
+
+
 def log_command(func):
-    """记录执行命令的 IP 地址、国家、时间和命令"""
+    """记录执行命令的时间、群、用户和命令"""
     @wraps(func)
     async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
-
-        # 获取当前时间（精确到秒）
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # 获取命令执行者的基本信息
-        user_id = update.effective_user.id
-        user_name = update.effective_user.full_name
-        command = update.message.text
-
-        # 记录日志到控制台或文件中
-        print(f"时间: {timestamp} | 命令: {command} | 用户ID: {user_id} | 用户名: {user_name} | IP: ")
-        with open('command_log.log', 'a') as log_file:
-            log_file.write(f"时间: {timestamp} | 命令: {command} | 用户ID: {user_id} | 用户名: {user_name} | 位置: | IP: ")
-
+        user = update.effective_user
+        message = update.effective_message
+        audit_log.log({
+            "time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "command": message.text if message else None,
+            "chat_id": update.effective_chat.id if update.effective_chat else None,
+            "user_id": user.id if user else None,
+            "user_name": user.full_name if user else None,
+        })
         return await func(update, context, *args, **kwargs)
 
     return wrapper
 
 
-def user_exists(user_id: Union[int, str]) -> None:
+async def user_exists(user_id: Union[int, str]) -> bool:
     """检查用户是否存在"""
-    db = DatabaseManager()
     try:
-        result = db.get_user_info(user_id)
-        return result is not None  # 如果查询到数据返回 True，否则返回 False
+        return await user_cache.get(user_id) is not None  # 先查进程内缓存，未命中才查数据库
     except Exception as e:
         logging.error(f"❌ 查询余额时发生错误: {e}")
-    finally:
-        db.close()
+        return False
@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# 进程池大小，0 表示不用进程池，全部在事件循环内执行
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", min(2, os.cpu_count() or 1)))
+# 下注数不超过该值的结算直接在事件循环内执行（进程间传输比计算本身还贵）
+SETTLE_INLINE_MAX = int(os.getenv("SETTLE_INLINE_MAX", 5000))
+
+_process_pool = None
+
+
+def _warm_up():
+    """子进程启动时预热走势图缓存"""
+    from game_logic_func import render_dice_board
+    render_dice_board([10])
+
+
+def start_process_pool():
+    """创建 CPU 密集任务进程池（spawn 方式，避免 fork 带上事件循环和数据库线程）"""
+    global _process_pool
+    if _process_pool is None and WORKER_PROCESSES > 0:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=WORKER_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_up,
+        )
+        logging.info(f"✅ 进程池已启动 ({WORKER_PROCESSES} 个进程)")
+    return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True, cancel_futures=True)
+        _process_pool = None
+
+
+async def run_cpu(func, *args, inline: bool = False):
+    """
+    在进程池中执行 CPU 密集函数并异步等待结果；
+    未启用进程池或 inline=True 时直接在当前线程执行
+    """
+    if inline or _process_pool is None:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_process_pool, func, *args)